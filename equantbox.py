@@ -6,13 +6,14 @@ SquishBox Raspberry Pi FluidPatcher interface
 
 __version__ = '0.0.2'
 
-import sys, glob, re
+import sys, re
 import subprocess
 from pathlib import Path
 import threading
 import serial
 import time
 import traceback
+from collections import deque
 
 import RPi.GPIO as GPIO
 
@@ -53,6 +54,7 @@ BLINK_TIME = 0.1
 SCROLL_TIME = 0.4
 SCROLL_PAUSE = 4
 POLL_TIME = 0.01
+SIGNAL_BACKLOG = 256
 BOUNCE_TIME = 0.02
 COLS, ROWS = 16, 2
 
@@ -90,6 +92,9 @@ class SquishBox():
           buttoncallback: When the state of a button connected to BTN_SW
             changes, this function is called with 1 if the button was
             pressed, 0 if it was released.
+          idlecallback: if set, this function is called with no arguments
+            every time update() polls the buttons, so that queued work is
+            also done while menus are waiting for input.
           wificon: contains either the WIFIUP or WIFIDOWN character
             depending on the last-known status of the wifi adapter
         """
@@ -114,6 +119,7 @@ class SquishBox():
         #self.encstate = 0b000000
         #self.encvalue = 0
         self.buttoncallback = None
+        self.idlecallback = None
 
         self.nokia_lines = []
         #self.disp = LCD.PCD8544(DC, RST, spi=SPI.SpiDev(SPI_PORT, SPI_DEVICE, max_speed_hz=4000000))
@@ -155,6 +161,7 @@ class SquishBox():
 
         Returns: an integer event code
         """
+        if self.idlecallback: self.idlecallback()
         callback = self.buttoncallback if callback else None
         t = time.time()
 #        for r in range(ROWS):
@@ -441,8 +448,12 @@ class FluidBox:
         """Creates the FluidBox"""
         self.pno = 0
         self.buttonstate = 0
-        fp.midi_callback = self.listener
+        self.signals = deque(maxlen=SIGNAL_BACKLOG)
+        self.polling = False
+        fp.midi_callback = self.signals.append
+        fp.subscribe(types=['note', 'noteoff', 'cc', 'prog', 'pbend', 'cpress', 'kpress', 'start', 'continue', 'stop'])
         sb.buttoncallback = self.handle_buttonevent
+        sb.idlecallback = self.poll_signals
         self.midi_connect()
         self.load_bank(fp.currentbank)
         while not fp.currentbank:
@@ -462,6 +473,23 @@ class FluidBox:
             fp.send_event(f"cc:{STOMP_MIDICHANNEL}:{STOMP_TOGGLE_CC}:{self.buttonstate}")
             sb.gpio_set(PIN_LED, self.buttonstate)
 
+    def poll_signals(self):
+        """Handles MidiSignals queued since the last call
+
+        FluidPatcher calls midi_callback on its dispatcher thread, so signals
+        are queued there and handled here on the main thread. This is called
+        every time sb.update() polls, so signals are handled while menus are
+        open too. A patch change signalled while a menu is open is applied
+        once the menu closes.
+        """
+        if self.polling: return
+        self.polling = True
+        try:
+            while self.signals:
+                self.listener(self.signals.popleft())
+        finally:
+            self.polling = False
+
     def listener(self, sig):
         """Handles MidiSignals from FluidPatcher
         
@@ -591,17 +619,8 @@ class FluidBox:
         lastbank = fp.currentbank
         lastpatch = fp.patches[self.pno] if fp.patches else ""
         if bank == "":
-            last = str(fp.bankdir / fp.currentbank) if fp.currentbank else ""
-            bankdir = Path(fp.bankdir)
-            yaml_files = sorted(glob.glob(str(bankdir / "*.yaml")))
-            _idx = 0
-            if last != "":
-                last_idx = yaml_files.index(last)
-                if len(yaml_files) > (last_idx+1):
-                    _idx = last_idx+1
-            bank = Path(yaml_files[_idx])
-            #bank = Path(Path(next_bank_path).name)
-            #if bank == "": return False
+            bank = fp.next_bank()
+            if bank == "": return False
         sb.lcd_write(bank.name, 0, mode='scroll', now=True)
         sb.lcd_write("loading patches", 1, mode='ljust', now=True)
         sb.progresswheel_start()
@@ -163,17 +163,19 @@ class SoundfontBrowser(wx.Dialog):
         self.presetlist.AppendColumn('Bank')
         self.presetlist.AppendColumn('Program')
         self.presetlist.AppendColumn('Name')
+        self.presetlist.AppendColumn('Samples')
         vbox = wx.BoxSizer(wx.VERTICAL)
         vbox.Add(self.presetlist, 1, wx.LEFT|wx.RIGHT|wx.EXPAND, 15)
         vbox.Add(self.CreateStdDialogButtonSizer(wx.OK|wx.CANCEL), 0, wx.ALL|wx.EXPAND, 10)
         self.SetSizer(vbox)
 
-        for bank, prog, name in presets:
-            self.presetlist.Append((f"{bank:03d}:", f"{prog:03d}:", name))
+        for bank, prog, name, nbytes, _ in presets:
+            self.presetlist.Append((f"{bank:03d}:", f"{prog:03d}:", name, f"{nbytes / 1024:.0f} KB"))
         
         self.presetlist.SetColumnWidth(0, wx.LIST_AUTOSIZE_USEHEADER)
         self.presetlist.SetColumnWidth(1, wx.LIST_AUTOSIZE_USEHEADER)
         self.presetlist.SetColumnWidth(2, wx.LIST_AUTOSIZE_USEHEADER)
+        self.presetlist.SetColumnWidth(3, wx.LIST_AUTOSIZE_USEHEADER)
         self.Bind(wx.EVT_LIST_ITEM_SELECTED, self.preset_select, self.presetlist)
         self.Bind(wx.EVT_LIST_ITEM_ACTIVATED, self.onActivate, self.presetlist)
         self.presetlist.SetItemState(0, wx.LIST_STATE_SELECTED, wx.LIST_STATE_SELECTED)
@@ -181,7 +183,7 @@ class SoundfontBrowser(wx.Dialog):
     def preset_select(self, event):
         if (i := event.GetIndex()) < 0:
             return
-        bank, prog, name = self.presets[i]
+        bank, prog, name, *_ = self.presets[i]
         warn = fp.select_sfpreset(self.sfrel, bank, prog)
         if warn:
             wx.MessageBox('\n'.join(warn), "Warning", wx.OK|wx.ICON_WARNING)
@@ -304,14 +306,13 @@ class MainWindow(wx.Frame):
         return True
 
     def next_bankfile(self):
-        banks = sorted([b.relative_to(fp.bankdir) for b in fp.bankdir.rglob('*.yaml')])
-        bno = (banks.index(fp.currentbank) + 1 ) % len(banks) if fp.currentbank in banks else 0
-        self.load_bankfile(banks[bno])
+        self.load_bankfile(fp.next_bank())
 
     def parse_bank(self, text=''):
         lastpatch = fp.patches[self.pno] if fp.patches else ''
         try:
-            fp.load_bank(raw=text or self.bedit.text.GetValue())
+            if text: fp.load_bank(raw=text)
+            else: fp.update_bank(self.bedit.text.GetValue())
         except Exception as e:
             wx.MessageBox(str(e), "Error Reading Bank", wx.OK|wx.ICON_ERROR)
             return False
@@ -391,12 +392,14 @@ class MainWindow(wx.Frame):
 
     def onExit(self, event=None):
         if isinstance(event, wx.CloseEvent) and not event.CanVeto():
+            fp.fsynth.delete()
             self.Destroy()
         if self.bedit.caption.GetLabel().endswith('*'):
             resp = wx.MessageBox("Unsaved changes in bank - quit?", "Exit", wx.ICON_WARNING|wx.OK|wx.CANCEL)
             if resp != wx.OK:
                 if hasattr(event, 'Veto'): event.Veto()
                 return
+        fp.fsynth.delete()
         self.Destroy()
         self.bedit.Destroy()
         self.midimon.Destroy()
@@ -420,7 +423,7 @@ class MainWindow(wx.Frame):
         if sf == '': return
         self.lastdir['sf2'] = Path(sf).parent
         sfrel = Path(sf).relative_to(fp.sfdir).as_posix()
-        if not (presets := fp.solo_soundfont(sfrel)):
+        if not (presets := fp.sfpresets(sfrel)) or not fp.solo_soundfont(sfrel):
             wx.MessageBox(f"Unable to load {sf}", "Error", wx.OK|wx.ICON_ERROR)
             return
         sfbrowser = SoundfontBrowser(self, sfrel, presets)
@@ -509,6 +512,8 @@ if __name__ == "__main__":
     cfgfile = sys.argv[1] if len(sys.argv) > 1 else 'fluidpatcherconf.yaml'
     fp = FluidPatcher(cfgfile)
     main = MainWindow()
-    fp.midi_callback = main.listener
+    # midi_callback runs on FluidPatcher's dispatcher thread, hand signals to the GUI thread
+    fp.midi_callback = lambda sig: wx.CallAfter(main.listener, sig)
+    fp.subscribe(types=MSG_TYPES)
     main.Show()
     app.MainLoop()
@@ -10,6 +10,10 @@ Includes:
 - pfluidsynth.py: ctypes bindings to libfluidsynth and wrapper classes
     for FluidSynth's features/functions
 - bankfiles.py: extensions to YAML and functions for parsing bank files
+- sfcatalog.py: reads soundfont presets from file headers and keeps
+    a catalog of them
+- fileindex.py: sorted index of a directory tree that follows changes
+- midifiles.py: reads MIDI files into memory and finds their bar lines
 
 Requires:
 - oyaml
@@ -18,11 +22,23 @@ Requires:
 
 __version__ = '0.8.2'
 
+import os
+import secrets
+import threading
+from collections import namedtuple, OrderedDict
 from pathlib import Path
 from copy import deepcopy
 
-from .bankfiles import parseyaml, renderyaml, SFPreset, MidiMessage, RouterRule
+from .bankfiles import parseyaml, parsebank, renderyaml, BankCache, PatchBank, CompiledBank, SFPreset, MidiMessage, RouterRule
+from .bankfiles import read_compiled, write_compiled, COMPILED_KEYFILE
+from .fileindex import FileIndex
+from .midifiles import read_midifile, MidiFileError
 from .pfluidsynth import Synth
+from .sfcatalog import SoundfontCatalog
+
+
+PatchPlan = namedtuple('PatchPlan', ['presets', 'sysex', 'fluidsettings', 'players', 'sequencers',
+                                     'arpeggiators', 'midiplayers', 'ladspafx', 'clear', 'rules', 'messages'])
 
 
 class FluidPatcher:
@@ -47,6 +63,8 @@ class FluidPatcher:
         result of parameter routing. Rules with a `patch` parameter will be modified
         by FluidPatcher so that the `patch` attribute corresponds to the patch index.
         If `patch` is -1, `val` is set to the patch increment.
+        The callback runs on a separate dispatcher thread, not the thread
+        that received the MIDI event - see the `dispatch` config settings.
     
     See the documentation for information on bank file format.
     """
@@ -68,12 +86,30 @@ class FluidPatcher:
         self.cfg = {}
         self.read_config()
         self.bank = {}
+        self._patchnames = []
+        self._patchindex = {}
+        self._compilekey = None
+        self.bankcache = BankCache(self.cfg.get('bankcache'), self._bankcache_key())
+        self._plans = {}
         self.soundfonts = set()
-        self.fsynth = Synth(**{**self.cfg.get('fluidsettings', {}), **fluidsettings})
+        self.sfcache = OrderedDict()
+        self.sfsizes = {}
+        self.sfstats = dict(hits=0, misses=0, evictions=0)
+        self.mfcache = {}
+        self._sflock = threading.RLock()
+        self._sfloaded = threading.Condition(self._sflock)
+        self._sfloading = set()
+        self._prefetch = None
+        self._indexes = {}
+        self.sfcatalog = SoundfontCatalog(self.cfg.get('sfcatalog', self.sfdir / '.sfcatalog.json'))
+        self.fsynth = Synth(**self.cfg.get('dispatch', {}),
+                            **{**self.cfg.get('fluidsettings', {}), **fluidsettings})
         self.fsynth.midi_callback = self._midisignal_handler
         self.max_channels = self.fluidsetting_get('synth.midi-channels')
         self.patchcord = {'patchcordxxx': {'lib': self.plugindir / 'patchcord', 'audio': 'mono'}}
         self.midi_callback = None
+        self.rulesapplied = None
+        self.rulereport = []
 
     @property
     def currentbank(self):
@@ -100,10 +136,24 @@ class FluidPatcher:
         """Path to LADSPA effects"""
         return Path(self.cfg.get('plugindir', '')).resolve()
 
+    @property
+    def bankindex(self):
+        """FileIndex of the bank files in `bankdir`"""
+        return self._index('bankdir', 'banks', ['.yaml'])
+
+    @property
+    def sfindex(self):
+        """FileIndex of the soundfonts in `soundfontdir`"""
+        return self._index('soundfontdir', 'sf2', ['.sf2', '.sf3'])
+
     @property
     def patches(self):
-        """List of patch names in the current bank"""
-        return list(self.bank.get('patches', {})) if self.bank else []
+        """List of patch names in the current bank
+
+        This list is kept up to date as patches are added and deleted,
+        and should not be modified.
+        """
+        return self._patchnames
 
     def read_config(self):
         """Read configuration from `cfgfile` set on creation
@@ -144,7 +194,11 @@ class FluidPatcher:
         to make it persistent.
 
         Upon loading, resets the synth, loads all necessary soundfonts,
-        and applies settings in the `init` element. Returns the yaml stream
+        and applies settings in the `init` element. Individual patches
+        are only parsed when first applied or accessed, so loading time
+        doesn't grow with the number of patches. If the bank file has been
+        compiled with compile_bank() since it was last changed, the compiled
+        bank is loaded instead of parsing it. Returns the yaml stream
         as a string. If called with no arguments, resets the synth and
         restores the current bank from memory.
 
@@ -154,10 +208,15 @@ class FluidPatcher:
 
         Returns: yaml stream that was loaded
         """
+        plans, mfiles = {}, {}
         if bankfile:
             try:
-                raw = (self.bankdir / bankfile).read_text()
-                bank = parseyaml(raw)
+                if prefetched := self._prefetch_take(bankfile):
+                    raw, bank, plans, mfiles = prefetched
+                elif compiled := read_compiled(self.bankdir / bankfile, self._compile_key(), self._compile_context()):
+                    raw, bank, plans = compiled.raw, compiled.bank, compiled.plans
+                else:
+                    raw, bank = self.bankcache.load(self.bankdir / bankfile)
             except:
                 if Path(bankfile).as_posix() == self.cfg['currentbank']:
                     self.cfg.pop('currentbank', None)
@@ -166,23 +225,199 @@ class FluidPatcher:
                 self.bank = bank
                 self.cfg['currentbank'] = Path(bankfile).as_posix()
         elif raw:
-            bank = parseyaml(raw)
+            bank = parsebank(raw)
             self.bank = bank
+        if bankfile or raw:
+            self.mfcache = mfiles
+        self._index_patches()
         self._reset_synth()
         self._refresh_bankfonts()
-        for zone in self.bank, *self.bank.get('patches', {}).values():
-            for midi in zone.get('midiplayers', {}).values():
-                midi['file'] = self.mfilesdir / midi['file']
-            for fx in zone.get('ladspafx', {}).values():
-                fx['lib'] = self.plugindir / fx['lib']
+        self._prepare_bank()
         for syx in self.bank.get('init', {}).get('sysex', []):
             self.fsynth.send_sysex(syx)
         for opt, val in self.bank.get('init', {}).get('fluidsettings', {}).items():
             self.fluidsetting_set(opt, val)
         for msg in self.bank.get('init', {}).get('messages', []):
             self.send_event(msg)
+        self._plans = dict(plans)
+        self._precompile()
         return raw
 
+    def compile_bank(self, bankfile=''):
+        """Compile a bank file for faster loading
+
+        Parses a bank file, builds all of its patches and their patch plans,
+        and writes them along with a list of the files the bank uses to a
+        binary file next to the bank file. load_bank() uses the compiled bank
+        as long as the bank file hasn't changed since and the soundfont, MIDI
+        file, and plugin directories are the same. Compiled banks are signed
+        with a key created in the config file's directory, and ones that
+        weren't signed with it are ignored. Compiling mostly helps banks
+        whose patches can't be parsed lazily, e.g. ones that use anchors.
+
+        Args:
+          bankfile: bank file to compile, defaults to `currentbank`
+
+        Returns: Path of the compiled bank
+        """
+        bankfile = self.bankdir / (bankfile or self.currentbank)
+        raw, bank = self.bankcache.load(bankfile)
+        patches = bank.get('patches', PatchBank())
+        zones = [bank, *patches.values()]
+        for zone in zones:
+            self._prepare_zone(zone)
+        plans = {name: self._compile_patch(name, bank) for name in [None, *patches]}
+        assets = dict(
+            soundfonts=sorted({sfont for sfont, _, _ in self._bankpresets(bank)}),
+            midifiles=sorted({str(midi['file']) for zone in zones for midi in zone.get('midiplayers', {}).values()}),
+            ladspalibs=sorted({str(fx['lib']) for zone in zones for fx in zone.get('ladspafx', {}).values()}))
+        return write_compiled(bankfile, CompiledBank(raw, bank, plans, assets, self._compile_context()),
+                              self._compile_key(create=True))
+
+    def update_bank(self, raw):
+        """Update the current bank in place from raw yaml text
+
+        Parses a yaml stream and compares it to the current bank, one
+        bank-level element and one patch at a time. Unchanged parts are
+        kept as they are, and only the soundfonts, players, effects, and
+        router rules affected by a change are reloaded - the synth is not
+        reset, so sound isn't interrupted while a bank is being edited.
+        The `init` element is applied again only if it changed. Call
+        apply_patch() afterward to hear changes to the current patch.
+
+        Args:
+          raw: string to parse
+
+        Returns: a list of the names of patches that were added or changed
+        """
+        new = parsebank(raw)
+        if not self.bank or not isinstance(new, dict):
+            self.load_bank(raw=raw)
+            return self.patches
+        old, oldpatches = self.bank, self.bank.get('patches', PatchBank())
+        same = lambda a, b: renderyaml(a) == renderyaml(b)
+        bank, sections, changed = {}, set(), []
+        for key, val in new.items():
+            if key == 'patches':
+                bank['patches'] = PatchBank()
+                for name in val:
+                    # patches that haven't been built can be compared by their text
+                    if name in oldpatches and not oldpatches.built(name) and not val.built(name):
+                        unchanged = oldpatches.data[name] == val.data[name]
+                    else:
+                        unchanged = name in oldpatches and same(oldpatches[name], val[name])
+                    if unchanged:
+                        bank['patches'].data[name] = oldpatches.data[name]
+                    else:
+                        bank['patches'].data[name] = val.data[name]
+                        changed.append(name)
+            elif key in old and same(old[key], val):
+                bank[key] = old[key]
+            else:
+                bank[key] = val
+                sections.add(key)
+        sections |= set(old) - set(new) - {'patches'}
+        removed = [name for name in oldpatches if name not in bank.get('patches', {})]
+        # players and effects whose definitions changed must be recreated
+        # unchanged patches define the same ones in both, so they're skipped
+        def defs(bank, names, kw):
+            d = {}
+            for zone in bank, *[bank['patches'][name] for name in names if name in bank.get('patches', {})]:
+                for name, obj in zone.get(kw, {}).items():
+                    d.setdefault(name, []).append(renderyaml(obj))
+            return {name: sorted(objs) for name, objs in d.items()}
+        stale = {}
+        for kw in 'sequencers', 'arpeggiators', 'midiplayers', 'ladspafx':
+            olddefs, newdefs = defs(old, changed + removed, kw), defs(bank, changed, kw)
+            stale[kw] = {name for name in olddefs if olddefs[name] != newdefs.get(name)}
+        self.bank = bank
+        self._index_patches()
+        self._prepare_bank()
+        players = stale['sequencers'] | stale['arpeggiators'] | stale['midiplayers']
+        if players:
+            self.fsynth.players_clear(save=set(self.fsynth.players) - players)
+        if stale['ladspafx']:
+            self.fsynth.fxchain_clear(save=set(self.fsynth.ladspafx) - stale['ladspafx'])
+        self._refresh_bankfonts()
+        if 'init' in sections:
+            for syx in bank.get('init', {}).get('sysex', []):
+                self.fsynth.send_sysex(syx)
+            for opt, val in bank.get('init', {}).get('fluidsettings', {}).items():
+                self.fluidsetting_set(opt, val)
+            for msg in bank.get('init', {}).get('messages', []):
+                self.send_event(msg)
+        if sections - {'init'}:
+            self._plans = {}
+        else:
+            for name in changed + removed:
+                self._plans.pop(name, None)
+        self._precompile()
+        return changed
+
+    def prefetch_bank(self, bankfile='', limit=None):
+        """Start loading a bank's soundfonts in the background
+
+        Parses a bank file and loads the soundfonts it uses on a separate
+        thread while the current bank keeps playing, and reads its MIDI files
+        into memory. If load_bank() is later called with the same file
+        (unchanged since), the parsed bank and MIDI files are reused and its
+        soundfonts are already loaded. Soundfonts that would bring
+        the total size of loaded soundfonts over `limit` are skipped.
+        Prefetched soundfonts aren't unloaded to stay within the `sfcache`
+        budget until another bank is loaded or prefetched. Soundfonts are
+        loaded without holding the soundfont lock, so patches can be applied
+        meanwhile, but a patch change that needs a soundfont the prefetch is
+        loading waits for it to finish. Any prefetch already in progress
+        is cancelled. Without a `limit` or an `sfcache` budget all of the
+        bank's soundfonts are loaded, so front ends should only prefetch
+        when a budget is set.
+
+        Args:
+          bankfile: bank file to prefetch, absolute or relative to `bankdir`.
+            If not given, the bank after `currentbank` in `bankdir` is used
+          limit: memory ceiling in MB, defaults to the `sfcache` budget,
+            or no limit if there's no budget
+        """
+        self.prefetch_cancel()
+        if not bankfile:
+            bankfile = self.next_bank()
+            if not bankfile: return
+        if limit == None:
+            limit = self.cfg.get('sfcache', {}).get('budget')
+        if limit != None:
+            limit *= 1024 * 1024
+        pre = dict(bankfile=Path(bankfile).as_posix(), cancel=threading.Event(), sfonts=set())
+        pre['worker'] = threading.Thread(target=self._prefetch_run, args=(pre, limit), daemon=True)
+        self._prefetch = pre
+        pre['worker'].start()
+
+    def next_bank(self, inc=1):
+        """Find the bank file `inc` places after `currentbank`
+
+        Bank files are ordered by their paths within `bankdir`, wrapping
+        around at either end. Uses `bankindex`, so the filesystem is only
+        scanned again when `bankdir` has changed.
+
+        Args:
+          inc: number of banks to step, negative to go backward
+
+        Returns: bank file path relative to `bankdir` - the first bank if
+          `currentbank` isn't in `bankdir`, or '' if there are no banks
+        """
+        return self.bankindex.step(self.currentbank, inc)
+
+    def prefetch_cancel(self):
+        """Stop any bank prefetch in progress
+
+        Soundfonts that were already loaded by the prefetch stay loaded, subject
+        to the `sfcache` budget, and the prefetched bank is discarded. Doesn't
+        wait for the worker - a soundfont it's in the middle of loading is
+        added to the cache when it's done.
+        """
+        if self._prefetch:
+            self._prefetch['cancel'].set()
+            self._prefetch = None
+
     def save_bank(self, bankfile, raw=''):
         """Save a bank file
         
@@ -195,11 +430,15 @@ class FluidPatcher:
           raw: exact text to save
         """
         if raw:
-            bank = parseyaml(raw)
+            bank = parsebank(raw)
             self.bank = bank
+            self._index_patches()
+            self._prepare_bank()
+            self._plans = {}
         else:
             raw = renderyaml(self.bank)
         (self.bankdir / bankfile).write_text(raw)
+        self.bankcache.discard(self.bankdir / bankfile)
         self.cfg['currentbank'] = Path(bankfile).as_posix()
 
     def apply_patch(self, patch):
@@ -211,6 +450,10 @@ class FluidPatcher:
         players and effects and deactivates unused ones, send messages, and
         applies fluidsettings. Patch settings are applied after bank settings.
         If the specified patch isn't found, only bank settings are applied.
+        Only what differs from the currently applied state is changed - presets,
+        fluidsettings, players, and effects that are already in place and
+        an unchanged set of router rules are left alone, so held notes
+        aren't disturbed. Messages and sysex are always sent.
 
         Args:
           patch: patch index or name
@@ -218,45 +461,47 @@ class FluidPatcher:
         Returns: a list of warnings, if any
         """
         warnings = []
-        patch = self._resolve_patch(patch)
-        def mrg(kw):
-            try: return self.bank.get(kw, {}) | patch.get(kw, {})
-            except TypeError: return self.bank.get(kw, []) + patch.get(kw, [])
+        plan = self._patch_plan(patch)
         # presets
-        for ch in range(1, self.max_channels + 1):
-            if p := self.bank.get(ch) or patch.get(ch):
-                if not self.fsynth.program_select(ch, self.sfdir / p.sfont, p.bank, p.prog):
+        for ch, sfont, p in plan.presets:
+            if p:
+                if not self.fsynth.program_select(ch, sfont, p.bank, p.prog):
                     warnings.append(f"Unable to select preset {p} on channel {ch}")
             else: self.fsynth.program_unset(ch)
         # sysex
-        for syx in mrg('sysex'):
+        for syx in plan.sysex:
             self.fsynth.send_sysex(syx)
         # fluidsettings
-        for opt, val in mrg('fluidsettings').items():
+        for opt, val in plan.fluidsettings:
             self.fluidsetting_set(opt, val)
         # sequencers, arpeggiators, midiplayers
-        self.fsynth.players_clear(save=[*mrg('sequencers'), *mrg('arpeggiators'), *mrg('midiplayers')])
-        for name, seq in mrg('sequencers').items():
+        self.fsynth.players_clear(save=plan.players)
+        for name, seq in plan.sequencers:
             self.fsynth.sequencer_add(name, **seq)
-        for name, arp in mrg('arpeggiators').items():
+        for name, arp in plan.arpeggiators:
             self.fsynth.arpeggiator_add(name, **arp)
-        for name, midi in mrg('midiplayers').items():
-            self.fsynth.midiplayer_add(name, **midi)
+        for name, midi in plan.midiplayers:
+            if name not in self.fsynth.players:
+                if mfile := self._mfcache_load(midi['file'], warnings):
+                    midi = {**midi, 'file': mfile.data, 'bars': mfile.nextbar}
+                self.fsynth.midiplayer_add(name, **midi)
         # ladspa effects
-        self.fsynth.fxchain_clear(save=mrg('ladspafx'))
-        for name, fx in (mrg('ladspafx') | self.patchcord).items():
+        self.fsynth.fxchain_clear(save=[name for name, _ in plan.ladspafx])
+        for name, fx in plan.ladspafx:
             self.fsynth.fxchain_add(name, **fx)
         self.fsynth.fxchain_connect()
-        # router rules -- invert b/c fluidsynth applies rules last-first
-        self.fsynth.router_default()
-        rules = [*mrg('router_rules')][::-1]
-        if 'clear' in rules:
-            self.fsynth.router_clear()
-            rules = rules[:rules.index('clear')]
-        for rule in rules:
-            rule.add(self.fsynth.router_addrule)
+        # router rules
+        if (plan.clear, plan.rules) != self.rulesapplied:
+            self.fsynth.router_default()
+            if plan.clear:
+                self.fsynth.router_clear()
+            self.rulesapplied = plan.clear, plan.rules
+            self.rulereport = []
+            for rule, calls in plan.rules:
+                for call in calls:
+                    self._add_rule_call(rule, call)
         # midi messages
-        for msg in mrg('messages'):
+        for msg in plan.messages:
             self.send_event(msg)
         return warnings
 
@@ -272,14 +517,20 @@ class FluidPatcher:
 
         Returns: the index of the new patch
         """
-        if 'patches' not in self.bank: self.bank['patches'] = {}
+        if 'patches' not in self.bank:
+            self.bank['patches'] = PatchBank()
+            self._prepare_bank()
         self.bank['patches'][name] = {}
+        if name not in self._patchindex:
+            self._patchindex[name] = len(self._patchnames)
+            self._patchnames.append(name)
+        self._plans = {}
         if addlike:
             addlike = self._resolve_patch(addlike)
             for x in addlike:
                 if not isinstance(x, int):
                     self.bank['patches'][name][x] = deepcopy(addlike[x])
-        return self.patches.index(name)
+        return self._patchindex[name]
 
     def update_patch(self, patch):
         """Update the current patch
@@ -295,6 +546,7 @@ class FluidPatcher:
           patch: index or name of the patch to update
         """
         patch = self._resolve_patch(patch)
+        self._plans = {}
         messages = set(patch.get('messages', []))
         for channel in range(1, self.max_channels + 1):
             info = self.fsynth.program_info(channel)
@@ -304,11 +556,10 @@ class FluidPatcher:
             sfont, bank, prog = info
             sfrel = Path(sfont).relative_to(self.sfdir).as_posix()
             patch[channel] = SFPreset(sfrel, bank, prog)
+            ccs = self.fsynth.get_ccs(channel)
             for cc, default in enumerate(_CC_DEFAULTS):
-                if default < 0: continue
-                val = self.fsynth.get_cc(channel, cc)
-                if val != default:
-                    messages.add(MidiMessage('cc', channel, cc, val))
+                if default >= 0 and ccs[cc] != default:
+                    messages.add(MidiMessage('cc', channel, cc, ccs[cc]))
         if messages:
             patch['messages'] = list(messages)
 
@@ -325,8 +576,30 @@ class FluidPatcher:
         else:
             name = patch
         del self.bank['patches'][name]
+        i = self._patchindex.pop(name)
+        del self._patchnames[i]
+        for j, name in enumerate(self._patchnames[i:], i):
+            self._patchindex[name] = j
+        self._plans = {}
         self._refresh_bankfonts()
 
+    def sfcache_stats(self):
+        """Report on soundfonts kept loaded between banks
+
+        Soundfonts that are no longer needed after a bank change are kept loaded,
+        as long as the total size of loaded soundfonts stays within the `budget`
+        (in MB) set in the `sfcache` section of the config. The least recently
+        used ones are unloaded first, except those listed under `pin`.
+
+        Returns: a dict with the number of soundfonts `loaded` and `cached` (loaded
+          but unused), their total size in `bytes`, the `budget` in bytes, and
+          the `hits`, `misses`, and `evictions` of the cache
+        """
+        cfg = self.cfg.get('sfcache', {})
+        return dict(loaded=len(self.soundfonts) + len(self.sfcache), cached=len(self.sfcache),
+                    bytes=sum(self.sfsizes.values()), budget=cfg.get('budget', 0) * 1024 * 1024,
+                    **self.sfstats)
+
     def fluidsetting_get(self, opt):
         """Get the current value of a FluidSynth setting
 
@@ -361,6 +634,7 @@ class FluidPatcher:
             patch = self._resolve_patch(patch)
             if 'fluidsettings' in patch and opt in patch['fluidsettings']:
                 del patch['fluidsettings'][opt]
+            self._plans = {}
 
     def add_router_rule(self, **pars):
         """Add a router rule to the Synth
@@ -373,7 +647,70 @@ class FluidPatcher:
         Returns:
           pars: router rule as a set of key=value pairs
         """
-        RouterRule(**pars).add(self.fsynth.router_addrule)
+        self._add_rule(RouterRule(**pars))
+        self.rulesapplied = None
+
+    def router_report(self):
+        """Report where the current router rules are being applied
+
+        Rules that only route MIDI messages without changing their type are
+        handled by FluidSynth's native router. Others must be handled in Python,
+        which is slower, and some have no effect at all. Rules are listed in
+        the order they were added.
+
+        Returns: a list of (rule, target, reason) tuples, where `target` is
+          'native', 'python', or None, and `reason` says why a rule couldn't
+          be routed natively
+        """
+        return list(self.rulereport)
+
+    def stats_enable(self, enable=True):
+        """Turn router instrumentation on or off
+
+        While enabled, the Synth counts how often each Python-side router
+        rule is checked, matched, and applied, and times how long it spends
+        routing each incoming event and in each call to `midi_callback`.
+        Enabling resets all counts. When disabled there is almost no overhead.
+
+        Args:
+          enable: True to start collecting, False to stop
+        """
+        self.fsynth.stats_enable(enable)
+
+    def stats_snapshot(self):
+        """Get a snapshot of router statistics
+
+        The rule and timing statistics are only present if instrumentation
+        has been turned on with stats_enable(). Times are in seconds, and
+        timing histograms have a `bins` list of upper bin edges and a `counts`
+        list with one extra overflow bin.
+
+        Returns: a dict with elements
+          rules: a list of dicts with a rule's `rule`, `checked`, `matched`,
+            and `applied` counts, busiest first
+          router: timing histogram for routing each incoming event
+          callback: timing histogram for calls to `midi_callback`
+          queue: depth, overflow, and lag statistics for the signal queue
+          eventpool: hit/miss counts for reused MIDI events
+        """
+        return self.fsynth.stats_snapshot()
+
+    def subscribe(self, types=None, chans=None, rules=None):
+        """Choose which MIDI signals are sent to `midi_callback`
+
+        Signals that aren't subscribed to are never created, which saves
+        effort when e.g. an external sequencer is sending MIDI clock or
+        dense CC streams that the callback would ignore. Each argument
+        is a list of values to accept, or None to accept everything.
+        Router rules that are handled by the Synth itself (fluidsettings,
+        players, effects) are unaffected.
+
+        Args:
+          types: MIDI message types of incoming events to pass on
+          chans: MIDI channels of incoming events to pass on
+          rules: custom router rule parameters to pass on, e.g. ['patch']
+        """
+        self.fsynth.subscribe(types, chans, rules)
 
     def send_event(self, msg=None, type='note', chan=0, par1=0, par2=None):
         """Send a MIDI event to the Synth
@@ -400,8 +737,7 @@ class FluidPatcher:
 
         Resets the Synth, loads a single soundfont, and creates router
         rules that route messages from all channels to channel 1.
-        Scans through each bank and program in order and retrieves the
-        preset name. After this, select_sfpreset() can be used to play
+        Preset names are read from the soundfont catalog. After this, select_sfpreset() can be used to play
         any instrument in the soundfont. Call load_bank() with no
         arguments to restore the current bank.
 
@@ -410,18 +746,23 @@ class FluidPatcher:
         
         Returns: a list of (bank, prog, name) tuples for each preset
         """
-        for sfont in self.soundfonts - {soundfont}:
-            self.fsynth.unload_soundfont(self.sfdir / sfont)
-        if {soundfont} - self.soundfonts:
-            if not self.fsynth.load_soundfont(self.sfdir / soundfont):
-                self.soundfonts = set()
-                return []
-        self.soundfonts = {soundfont}
+        with self._sflock:
+            for sfont in self.soundfonts - {soundfont}:
+                self._sfcache_release(sfont)
+            if {soundfont} - self.soundfonts:
+                if not self._sfcache_load(soundfont):
+                    self.soundfonts = set()
+                    self._sfcache_trim()
+                    return []
+            self.soundfonts = {soundfont}
+            self._sfcache_trim()
         self._reset_synth()
         for channel in range(1, self.max_channels + 1):
             self.fsynth.program_unset(channel)
         for type in 'note', 'cc', 'pbend', 'cpress', 'kpress':
             self.add_router_rule(type=type, chan=f"2-{self.max_channels}=1")
+        if presets := self.sfpresets(soundfont):
+            return [preset[:3] for preset in presets]
         return self.fsynth.get_sfpresets(self.sfdir / soundfont)
         
     def select_sfpreset(self, sfont, bank, prog, *_):
@@ -446,12 +787,63 @@ class FluidPatcher:
             return []
         else: return [f"Unable to select preset {str(sfont)}:{bank:03d}:{prog:03d}"]
 
+    def sfpresets(self, soundfont):
+        """List the presets in a soundfont without loading it
+
+        Presets are read from the soundfont's headers and stored in
+        the soundfont catalog, so only the first call for a file (or
+        the first after it changes) has to read it.
+
+        Args:
+          soundfont: soundfont file, absolute or relative to `sfdir`
+
+        Returns: a list of (bank, prog, name, sample bytes, zone count)
+          tuples for each preset, empty if the file can't be read
+        """
+        presets = self.sfcatalog.presets(self.sfdir / soundfont)
+        self.sfcatalog.save()
+        return presets or []
+
+    def catalog_soundfonts(self, workers=None):
+        """Update the soundfont catalog for all soundfonts in `sfdir`
+
+        Reads the headers of new or modified soundfonts using a pool
+        of processes and writes the catalog to disk.
+
+        Args:
+          workers: number of processes to use, defaults to the number of CPUs
+        """
+        self.sfcatalog.rebuild([self.sfdir / sfont for sfont in self.sfindex.files], workers)
+        self.sfcatalog.save()
+
+    def check_bank(self, raw=''):
+        """Check that a bank's soundfont presets exist
+
+        Uses the soundfont catalog, so no soundfonts are loaded.
+
+        Args:
+          raw: bank yaml to check, if empty checks the current bank
+
+        Returns: a list of warnings, empty if none
+        """
+        bank = parsebank(raw) if raw else self.bank
+        warnings = []
+        for p in [SFPreset(*p) for p in sorted(self._bankpresets(bank))]:
+            presets = self.sfpresets(p.sfont)
+            if not presets:
+                msg = f"Unable to read soundfont {p.sfont}"
+            elif (p.bank, p.prog) not in {preset[:2] for preset in presets}:
+                msg = f"Preset {p} not found"
+            else: continue
+            if msg not in warnings: warnings.append(msg)
+        return warnings
+
     def _midisignal_handler(self, sig):
         if 'patch' in sig:
-            if sig.patch in self.patches:
-                sig.patch = self.patches.index(sig.patch)
+            if sig.patch in self._patchindex:
+                sig.patch = self._patchindex[sig.patch]
             elif sig.patch == 'select':
-                sig.patch = int(sig.val) % len(self.patches)
+                sig.patch = int(sig.val) % len(self._patchnames)
             elif sig.patch[-1] in '+-':
                 sig.val = int(sig.patch[-1] + sig.patch[:-1])
                 sig.patch = -1
@@ -460,23 +852,227 @@ class FluidPatcher:
                 sig.val = 0
         if self.midi_callback: self.midi_callback(sig)
 
+    def _add_rule(self, rule):
+        for target, reason in rule.add(self.fsynth.router_addrule):
+            self.rulereport.append((str(rule), target, reason))
+
+    def _add_rule_call(self, rule, call):
+        type, chan, pars = call
+        res = self.fsynth.router_addrule(type, chan, **pars)
+        if (str(rule), *res) not in self.rulereport:
+            self.rulereport.append((str(rule), *res))
+
+    def _patch_plan(self, patch):
+        if isinstance(patch, int):
+            patch = self._patchnames[patch] if 0 <= patch < len(self._patchnames) else None
+        elif patch not in self._patchindex:
+            patch = None
+        if patch not in self._plans:
+            self._plans[patch] = self._compile_patch(patch)
+        return self._plans[patch]
+
+    def _compile_patch(self, name, bank=None):
+        bank = self.bank if bank == None else bank
+        patch = bank['patches'][name] if name != None else {}
+        def mrg(kw):
+            try: return bank.get(kw, {}) | patch.get(kw, {})
+            except TypeError: return bank.get(kw, []) + patch.get(kw, [])
+        sfdir = self.sfdir
+        presets = []
+        for ch in range(1, self.max_channels + 1):
+            if p := bank.get(ch) or patch.get(ch):
+                presets.append((ch, sfdir / p.sfont, p))
+            else: presets.append((ch, None, None))
+        # invert rules b/c fluidsynth applies rules last-first
+        rules = [*mrg('router_rules')][::-1]
+        clear = 'clear' in rules
+        if clear:
+            rules = rules[:rules.index('clear')]
+        players = [*mrg('sequencers'), *mrg('arpeggiators'), *mrg('midiplayers')]
+        return PatchPlan(
+            presets=tuple(presets),
+            sysex=tuple(mrg('sysex')),
+            fluidsettings=tuple(mrg('fluidsettings').items()),
+            players=tuple(players),
+            sequencers=tuple((name, {**seq}) for name, seq in mrg('sequencers').items()),
+            arpeggiators=tuple((name, {**arp}) for name, arp in mrg('arpeggiators').items()),
+            midiplayers=tuple((name, {**midi}) for name, midi in mrg('midiplayers').items()),
+            ladspafx=tuple((name, {**fx}) for name, fx in (mrg('ladspafx') | self.patchcord).items()),
+            clear=clear,
+            rules=tuple((rule, tuple(rule.calls())) for rule in rules),
+            messages=tuple(mrg('messages')))
+
     def _refresh_bankfonts(self):
-        sfneeded = set()
-        for zone in self.bank, *self.bank.get('patches', {}).values():
-            for sfont in [zone[ch].sfont for ch in zone if isinstance(ch, int)]:
-                sfneeded.add(sfont)
+        sfneeded = {sfont for sfont, _, _ in self._bankpresets(self.bank)}
         missing = set()
-        for sfont in self.soundfonts - sfneeded:
+        with self._sflock:
+            for sfont in self.soundfonts - sfneeded:
+                self._sfcache_release(sfont)
+            for sfont in sfneeded - self.soundfonts:
+                if not self._sfcache_load(sfont):
+                    missing.add(sfont)
+            self.soundfonts = sfneeded - missing
+            self._sfcache_trim()
+
+    def _compile_key(self, create=False):
+        # compiled banks are signed with a key kept next to the config file,
+        # so only banks compiled by this install are unpickled
+        if self._compilekey == None:
+            if self.cfgfile == None:
+                self._compilekey = secrets.token_bytes(32)
+                return self._compilekey
+            keyfile = self.cfgfile.with_name(COMPILED_KEYFILE)
+            try: self._compilekey = keyfile.read_bytes()
+            except OSError:
+                if not create: return None
+                key = secrets.token_bytes(32)
+                with os.fdopen(os.open(keyfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as f:
+                    f.write(key)
+                self._compilekey = key
+        return self._compilekey
+
+    def _bankcache_key(self):
+        # stored parsed banks are signed with the same key as compiled banks
+        if not self.cfg.get('bankcache'): return None
+        try: return self._compile_key(create=True)
+        except OSError: return None
+
+    def _compile_context(self):
+        # compiled banks contain absolute paths and per-channel plans
+        return str(self.sfdir), str(self.mfilesdir), str(self.plugindir), self.max_channels
+
+    def _index_patches(self):
+        self._patchnames = list(self.bank.get('patches', {}))
+        self._patchindex = {name: i for i, name in enumerate(self._patchnames)}
+
+    def _bankpresets(self, bank):
+        presets = {(bank[ch].sfont, bank[ch].bank, bank[ch].prog) for ch in bank if isinstance(ch, int)}
+        patches = bank.get('patches', PatchBank())
+        for name in patches:
+            presets |= patches.presets(name)
+        return presets
+
+    def _prepare_bank(self):
+        # patches are prepared as they're built
+        patches = self.bank.get('patches', PatchBank())
+        patches.prepare = self._prepare_zone
+        for zone in self.bank, *[patches[name] for name in patches if patches.built(name)]:
+            self._prepare_zone(zone)
+
+    def _prepare_zone(self, zone):
+        # paths that are already absolute are unaffected
+        for midi in zone.get('midiplayers', {}).values():
+            midi['file'] = self.mfilesdir / midi['file']
+        for fx in zone.get('ladspafx', {}).values():
+            fx['lib'] = self.plugindir / fx['lib']
+
+    def _precompile(self):
+        patches = self.bank.get('patches', PatchBank())
+        for name in [None, *[name for name in patches if patches.built(name)]]:
+            self._patch_plan(name)
+
+    def _prefetch_run(self, pre, limit):
+        path = self.bankdir / pre['bankfile']
+        cancel = pre['cancel']
+        try:
+            mtime = path.stat().st_mtime
+            if compiled := read_compiled(path, self._compile_key(), self._compile_context()):
+                raw, bank, plans = compiled.raw, compiled.bank, compiled.plans
+                sfonts, mfiles = compiled.assets['soundfonts'], compiled.assets['midifiles']
+            else:
+                (raw, bank), plans = self.bankcache.load(path), {}
+                sfonts = {sfont for sfont, _, _ in self._bankpresets(bank)}
+                mfiles = {midi['file'] for midi in bank.get('midiplayers', {}).values()}
+                patches = bank.get('patches', PatchBank())
+                for name in patches:
+                    mfiles |= patches.mfiles(name)
+        except Exception:
+            return
+        pre.update(mtime=mtime, raw=raw, bank=bank, plans=plans, mfiles={})
+        for sfont in sorted(sfonts):
+            if cancel.is_set(): return
+            with self._sflock:
+                if sfont in self.soundfonts or sfont in self.sfcache or sfont in self._sfloading: continue
+                try: size = (self.sfdir / sfont).stat().st_size
+                except OSError: continue
+                if limit != None and sum(self.sfsizes.values()) + size > limit: continue
+                self._sfloading.add(sfont)
+            # load outside the lock, _sfcache_load() waits if it needs this soundfont
+            loaded = self.fsynth.load_soundfont(self.sfdir / sfont)
+            with self._sflock:
+                if loaded:
+                    self.sfsizes[sfont] = size
+                    self.sfcache[sfont] = size
+                    pre['sfonts'].add(sfont)
+                self._sfloading.discard(sfont)
+                self._sfloaded.notify_all()
+        for mfile in sorted(mfiles, key=str):
+            if cancel.is_set(): return
+            try: pre['mfiles'][self.mfilesdir / mfile] = read_midifile(self.mfilesdir / mfile)
+            except (OSError, MidiFileError): pass
+
+    def _prefetch_take(self, bankfile):
+        pre = self._prefetch
+        # whatever the worker has done so far is used, the rest is loaded as needed
+        self.prefetch_cancel()
+        if not pre or pre['bankfile'] != Path(bankfile).as_posix(): return None
+        try:
+            if (self.bankdir / bankfile).stat().st_mtime != pre.get('mtime'): return None
+        except OSError:
+            return None
+        return pre['raw'], pre['bank'], pre['plans'], dict(pre['mfiles'])
+
+    def _sfcache_load(self, sfont):
+        while sfont in self._sfloading:
+            self._sfloaded.wait()
+        if sfont in self.sfcache:
+            del self.sfcache[sfont]
+            self.sfstats['hits'] += 1
+            return True
+        self.sfstats['misses'] += 1
+        if not self.fsynth.load_soundfont(self.sfdir / sfont):
+            return False
+        try: self.sfsizes[sfont] = (self.sfdir / sfont).stat().st_size
+        except OSError: self.sfsizes[sfont] = 0
+        return True
+
+    def _mfcache_load(self, mfile, warnings):
+        # MIDI files are read once per bank, unreadable ones are left to fluidsynth
+        if mfile not in self.mfcache:
+            try: self.mfcache[mfile] = read_midifile(mfile)
+            except (OSError, MidiFileError) as e:
+                warnings.append(f"Unable to read MIDI file {mfile}: {e}")
+                self.mfcache[mfile] = None
+        return self.mfcache[mfile]
+
+    def _sfcache_release(self, sfont):
+        self.sfcache[sfont] = self.sfsizes.get(sfont, 0)
+
+    def _sfcache_trim(self):
+        cfg = self.cfg.get('sfcache', {})
+        budget = cfg.get('budget', 0) * 1024 * 1024
+        pinned = set(cfg.get('pin', []))
+        if self._prefetch: pinned |= self._prefetch['sfonts']
+        resident = sum(self.sfsizes.get(sf, 0) for sf in self.soundfonts) + sum(self.sfcache.values())
+        for sfont in list(self.sfcache):
+            if resident <= budget: break
+            if sfont in pinned: continue
             self.fsynth.unload_soundfont(self.sfdir / sfont)
-        for sfont in sfneeded - self.soundfonts:
-            if not self.fsynth.load_soundfont(self.sfdir / sfont):
-                missing.add(sfont)
-        self.soundfonts = sfneeded - missing
+            resident -= self.sfcache.pop(sfont)
+            self.sfsizes.pop(sfont, None)
+            self.sfstats['evictions'] += 1
+
+    def _index(self, opt, default, suffixes):
+        dir = self.cfg.get(opt, default)
+        if opt not in self._indexes or self._indexes[opt][0] != dir:
+            if opt in self._indexes: self._indexes[opt][1].close()
+            self._indexes[opt] = dir, FileIndex(Path(dir).resolve(), suffixes)
+        return self._indexes[opt][1]
 
     def _resolve_patch(self, patch):
         if isinstance(patch, int):
-            if 0 <= patch < len(self.patches):
-                patch = self.patches[patch]
+            if 0 <= patch < len(self._patchnames):
+                patch = self._patchnames[patch]
             else: patch = {}
         if isinstance(patch, str):
             patch = self.bank.get('patches', {}).get(patch, {})
@@ -486,6 +1082,8 @@ class FluidPatcher:
         self.fsynth.players_clear()
         self.fsynth.fxchain_clear()
         self.fsynth.router_default()
+        self.rulesapplied = None
+        self.rulereport = []
         self.fsynth.reset()
         for opt, val in {**_SYNTH_DEFAULTS, **self.cfg.get('fluidsettings', {})}.items():
             self.fluidsetting_set(opt, val)
@@ -1,7 +1,15 @@
 """YAML extensions for fluidpatcher
 """
 
+import functools
+import hashlib
+import hmac
+import pickle
 import re
+import struct
+from collections import namedtuple
+from collections.abc import MutableMapping
+from pathlib import Path
 import yaml
 
 sfp = re.compile('^(.+\.sf2):(\d+):(\d+)$', flags=re.I)
@@ -10,14 +18,22 @@ msg = re.compile(f'^(note|cc|prog|pbend|cpress|kpress|noteoff):(\d+):({nn}):?(\d
 rspec = re.compile(f'^({nn})-({nn})\*(-?[\d\.]+)([+-]{nn})$')
 ftspec = re.compile(f'^({nn})?-?({nn})?=?(-?{nn})?-?(-?{nn})?$')
 scinote = re.compile('([+-]?)([A-G])([b#]?)(-?[0-9])') # scientific note name parts
+linebreak = re.compile('\r\n|[\r\n\x85\u2028\u2029]')
 
-handlers = dict(Loader=yaml.SafeLoader, Dumper=yaml.SafeDumper)
-yaml.add_implicit_resolver('!sfpreset', sfp, **handlers)
-yaml.add_implicit_resolver('!midimsg', msg, **handlers)
+# extensions are registered on the libyaml-based classes too when available,
+# so both build the same objects and parsing can use the faster one
+LOADERS = [yaml.SafeLoader, *([yaml.CSafeLoader] if yaml.__with_libyaml__ else [])]
+DUMPERS = [yaml.SafeDumper, *([yaml.CSafeDumper] if yaml.__with_libyaml__ else [])]
+Loader, Dumper = LOADERS[-1], DUMPERS[-1]
+
+for handlers in [dict(Loader=l, Dumper=d) for l, d in zip(LOADERS, DUMPERS)]:
+    yaml.add_implicit_resolver('!sfpreset', sfp, **handlers)
+    yaml.add_implicit_resolver('!midimsg', msg, **handlers)
 
 def add_bankobj_resolver(tag, path, kind):
-    yaml.add_path_resolver(tag, path, kind, **handlers)
-    yaml.add_path_resolver(tag, ['patches', (dict, None), *path], kind, **handlers)
+    for handlers in [dict(Loader=l, Dumper=d) for l, d in zip(LOADERS, DUMPERS)]:
+        yaml.add_path_resolver(tag, path, kind, **handlers)
+        yaml.add_path_resolver(tag, ['patches', (dict, None), *path], kind, **handlers)
 
 add_bankobj_resolver('!rrule', ['router_rules', (list, None)], dict)
 add_bankobj_resolver('!midiplayer', ['midiplayers', (dict, None)], dict)
@@ -46,7 +62,7 @@ def sift(s):
 
 def parseyaml(text='', data={}):
     """prune branches that contain None instances"""
-    data = yaml.safe_load(text) if text else data
+    data = yaml.load(text, Loader=Loader) if text else data
     if isinstance(data, (list, dict)):
         for item in data if isinstance(data, list) else data.values():
             if item is None: return None
@@ -56,13 +72,309 @@ def parseyaml(text='', data={}):
 
 def renderyaml(data):
     """sort_keys=False preserves dict order"""
-    return yaml.safe_dump(data, sort_keys=False)
+    return yaml.dump(data, Dumper=Dumper, sort_keys=False)
+
+def parsebank(text):
+    """parse a bank, indexing its patches to be built when first used
+
+    The whole text is parsed into yaml events, which checks its syntax
+    but is much cheaper than building it, and patches in block style are
+    located from the events and kept as text. Banks that can't be indexed
+    this way, e.g. because they use flow style or anchors in `patches`,
+    are parsed all at once.
+    """
+    if index := _indexpatches(text):
+        start, end, patches = index
+        bank = parseyaml(text[:start] + ': {}\n' + text[end:])
+        if isinstance(bank, dict):
+            bank['patches'] = PatchBank(patches)
+            return bank
+    bank = parseyaml(text)
+    if isinstance(bank, dict) and isinstance(bank.get('patches'), dict):
+        bank['patches'] = PatchBank(bank['patches'])
+    return bank
+
+def _indexpatches(text):
+    """find the patches in a bank's yaml text without building them
+
+    Returns: the start and end of the `patches` value in text and a list
+      of (name, PatchSource), or None if the text can't be indexed
+
+    Raises: yaml.YAMLError if the text isn't valid yaml
+    """
+    events = list(yaml.parse(text, Loader=Loader))
+    if text[:1] == '\ufeff' or sum(isinstance(e, yaml.DocumentStartEvent) for e in events) != 1: return None
+    if not isinstance(events[2], yaml.MappingStartEvent) or events[2].flow_style: return None
+    lines = [0] + [m.end() for m in linebreak.finditer(text)]
+    # index after each node, so mappings can be walked without descending into their items
+    ends, stack = list(range(1, len(events) + 1)), []
+    for i, e in enumerate(events):
+        if isinstance(e, yaml.CollectionStartEvent): stack.append(i)
+        elif isinstance(e, yaml.CollectionEndEvent): ends[stack.pop()] = i + 1
+    keys = [(key, j) for key, j, _ in _pairs(events, ends, 2)]
+    top = [k for k, (key, _) in enumerate(keys) if isinstance(key, yaml.ScalarEvent)
+           and key.tag == None and key.value == 'patches']
+    if len(top) != 1: return None
+    key, i = keys[top[0]]
+    if not _blockmap(events, i): return None
+    start = lines[key.end_mark.line] + key.end_mark.column
+    if text[start:start + 80].lstrip(' \t')[:1] != ':': return None
+    if top[0] + 1 == len(keys): end = len(text)
+    elif isinstance(keys[top[0] + 1][0], yaml.ScalarEvent): end = lines[keys[top[0] + 1][0].start_mark.line]
+    else: return None
+    patches = []
+    for name, j, k in _pairs(events, ends, i):
+        if not isinstance(name, yaml.ScalarEvent) or name.anchor or name.tag: return None
+        if not _blockmap(events, j) or events[j].start_mark.line <= name.start_mark.line: return None
+        if any(e.anchor for e in events[j:k] if isinstance(e, yaml.NodeEvent)): return None
+        # parseyaml() prunes the whole bank over a null, so leave that to a full parse
+        if any(_isnull(e) for e in events[j:k] if isinstance(e, yaml.ScalarEvent)): return None
+        presets, mfiles = set(), set()
+        for key, v, _ in _pairs(events, ends, j):
+            if not isinstance(key, yaml.ScalarEvent): continue
+            val = events[v]
+            if isinstance(val, yaml.ScalarEvent) and val.implicit[0] and isinstance(_scalar(key), int):
+                if m := sfp.match(val.value): presets.add((m[1], int(m[2]), int(m[3])))
+            elif isinstance(val, yaml.MappingStartEvent) and _scalar(key) == 'midiplayers':
+                for _, p, _ in _pairs(events, ends, v):
+                    if not isinstance(events[p], yaml.MappingStartEvent): continue
+                    for key, f, _ in _pairs(events, ends, p):
+                        if isinstance(key, yaml.ScalarEvent) and isinstance(events[f], yaml.ScalarEvent) \
+                           and _scalar(key) == 'file':
+                            mfiles.add(_scalar(events[f]))
+        patches.append((name, j, presets, mfiles))
+    bounds = [lines[events[j].start_mark.line] for _, j, _, _ in patches] + [end]
+    ends = [lines[name.start_mark.line] for name, _, _, _ in patches[1:]] + [end]
+    return start, end, [(_scalar(name), PatchSource(text[b0:b1], presets, mfiles))
+                        for (name, _, presets, mfiles), b0, b1 in zip(patches, bounds, ends)]
+
+def _pairs(events, ends, i):
+    """(key event, value index, end index) of each item of the mapping at events[i]"""
+    i += 1
+    while not isinstance(events[i], yaml.MappingEndEvent):
+        j = ends[i]
+        yield events[i], j, ends[j]
+        i = ends[j]
+
+def _blockmap(events, i):
+    e = events[i]
+    return isinstance(e, yaml.MappingStartEvent) and not e.flow_style and not e.anchor and e.tag == None
+
+def _isnull(event):
+    return event.tag == 'tag:yaml.org,2002:null' or event.implicit[0] and _scalar(event) == None
+
+def _scalar(event):
+    """value of a scalar event, only parsed if it may not be a plain string"""
+    return _plainscalar(event.value) if event.implicit[0] else event.value
+
+@functools.lru_cache(maxsize=1024)
+def _plainscalar(scalar):
+    if any(regexp.match(scalar) for _, regexp in Loader.yaml_implicit_resolvers.get(scalar[:1], [])):
+        return yaml.load(scalar, Loader=Loader)
+    return scalar
+
+
+PatchSource = namedtuple('PatchSource', ['text', 'presets', 'mfiles'])
+
+
+class PatchBank(MutableMapping):
+    """The patches in a bank, built from yaml when first used
+
+    Works like a dict of patches, but patches indexed by parsebank() are
+    kept as their yaml text and only parsed when retrieved. Names,
+    membership, and the soundfont presets and MIDI files each patch uses
+    are available without building anything.
+
+    Attributes:
+      prepare: optional function called with each patch when it's built
+    """
+
+    def __init__(self, patches=()):
+        self.data = dict(patches)
+        self.prepare = None
+
+    def __getitem__(self, name):
+        patch = self.data[name]
+        if isinstance(patch, PatchSource):
+            built = parseyaml(f"patches:\n x:\n{patch.text}")
+            patch = self.data[name] = built['patches']['x']
+            if self.prepare: self.prepare(patch)
+        return patch
+
+    def __setitem__(self, name, patch):
+        self.data[name] = patch
+
+    def __delitem__(self, name):
+        del self.data[name]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, name):
+        return name in self.data
+
+    def __getstate__(self):
+        return dict(self.__dict__, prepare=None)
+
+    def built(self, name):
+        """whether a patch has been built"""
+        return not isinstance(self.data[name], PatchSource)
+
+    def presets(self, name):
+        """set of (sfont, bank, prog) for the presets a patch selects"""
+        patch = self.data[name]
+        if isinstance(patch, PatchSource): return patch.presets
+        return {(p.sfont, p.bank, p.prog) for ch, p in patch.items()
+                if isinstance(ch, int) and isinstance(p, SFPreset)}
+
+    def mfiles(self, name):
+        """set of MIDI files used by a patch's midiplayers"""
+        patch = self.data[name]
+        if isinstance(patch, PatchSource): return patch.mfiles
+        return {midi['file'] for midi in patch.get('midiplayers', {}).values()}
+
+
+class BankCache:
+    """Cache of parsed bank files
+
+    Parsed banks are stored pickled, so each load returns new objects
+    that can be modified freely, and unpickling is much faster than
+    parsing yaml. An entry is reused as long as the file's size and
+    mtime are unchanged, or if its contents hash the same. If `cachedir`
+    and `key` are given, parsed banks are also stored there by content hash
+    so the cache survives restarts. Stored banks are signed with an
+    HMAC-SHA256 using `key`, and ones whose signature doesn't match are
+    parsed again rather than unpickled.
+    """
+
+    version = 4
+
+    def __init__(self, cachedir=None, key=None):
+        self.cachedir = Path(cachedir) if cachedir and key else None
+        self.key = key
+        self.entries = {}
+
+    def load(self, bankfile):
+        """Read and parse a bank file, using the cache if possible
+
+        Returns: a tuple of the raw file contents and the parsed bank
+        """
+        path = Path(bankfile).resolve()
+        st = path.stat()
+        stamp = st.st_size, st.st_mtime_ns
+        entry = self.entries.get(path)
+        if entry and entry[0] == stamp:
+            return entry[2], pickle.loads(entry[3])
+        raw = path.read_text()
+        digest = hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+        data = entry[3] if entry and entry[1] == digest else self._read(digest)
+        try: bank = pickle.loads(data)
+        except Exception: data = None
+        if data == None:
+            bank = parsebank(raw)
+            data = pickle.dumps(bank)
+            self._write(digest, data)
+        self.entries[path] = stamp, digest, raw, data
+        return raw, bank
+
+    def discard(self, bankfile):
+        """Remove a bank file from the in-memory cache"""
+        self.entries.pop(Path(bankfile).resolve(), None)
+
+    def _file(self, digest):
+        return self.cachedir / f"{digest}.v{self.version}.pickle"
+
+    def _read(self, digest):
+        if self.cachedir:
+            try: data = self._file(digest).read_bytes()
+            except OSError: return None
+            sig = hmac.digest(self.key, digest.encode() + data[32:], 'sha256')
+            if hmac.compare_digest(sig, data[:32]): return data[32:]
+        return None
+
+    def _write(self, digest, data):
+        if self.cachedir:
+            sig = hmac.digest(self.key, digest.encode() + data, 'sha256')
+            try:
+                self.cachedir.mkdir(parents=True, exist_ok=True)
+                self._file(digest).write_bytes(sig + data)
+            except OSError: pass
+
+COMPILED_SUFFIX = '.fpbank'
+COMPILED_MAGIC = b'FPBANK'
+COMPILED_VERSION = 2
+COMPILED_KEYFILE = '.fpbankkey'
+
+CompiledBank = namedtuple('CompiledBank', ['raw', 'bank', 'plans', 'assets', 'context'])
+
+def compiled_path(bankfile):
+    """path of the compiled artifact for a bank file"""
+    return Path(bankfile).with_suffix(COMPILED_SUFFIX)
+
+def write_compiled(bankfile, compiled, key, stamp=None):
+    """write a CompiledBank next to its bank file
+
+    The artifact is a short header (magic bytes and format version)
+    followed by the size and mtime of the bank file it was compiled from,
+    an HMAC-SHA256 of the header and data, and the pickled CompiledBank.
+
+    Args:
+      bankfile: path to the bank file
+      compiled: a CompiledBank
+      key: secret key used to sign the artifact
+      stamp: (size, mtime_ns) of the bank file when it was read, defaults
+        to its current size and mtime
+
+    Returns: the path of the artifact
+    """
+    path = compiled_path(bankfile)
+    stamp = stamp or _stamp(bankfile)
+    header = COMPILED_MAGIC + struct.pack('<HQq', COMPILED_VERSION, *stamp)
+    data = pickle.dumps(tuple(compiled))
+    path.write_bytes(header + hmac.digest(key, header + data, 'sha256') + data)
+    return path
+
+def read_compiled(bankfile, key, context=None):
+    """read the compiled artifact for a bank file if it can be used
+
+    The artifact is ignored if it wasn't signed with `key`, the bank file
+    has changed since it was compiled, it was written by a different
+    format version, or (if `context` is given) it was compiled in a
+    different context. The signature is checked before anything is
+    unpickled, so artifacts from elsewhere are never loaded.
+
+    Returns: a CompiledBank, or None
+    """
+    if not key: return None
+    path = compiled_path(bankfile)
+    try:
+        stamp = _stamp(bankfile)
+        data = path.read_bytes()
+    except OSError:
+        return None
+    header = len(COMPILED_MAGIC) + struct.calcsize('<HQq')
+    if len(data) < header + 32 or data[:len(COMPILED_MAGIC)] != COMPILED_MAGIC: return None
+    version, *compiledstamp = struct.unpack_from('<HQq', data, len(COMPILED_MAGIC))
+    if version != COMPILED_VERSION or tuple(compiledstamp) != stamp: return None
+    sig = hmac.digest(key, data[:header] + data[header + 32:], 'sha256')
+    if not hmac.compare_digest(sig, data[header:header + 32]): return None
+    try: compiled = CompiledBank(*pickle.loads(data[header + 32:]))
+    except Exception: return None
+    if context != None and compiled.context != context: return None
+    return compiled
+
+def _stamp(file):
+    st = Path(file).stat()
+    return st.st_size, st.st_mtime_ns
 
 
 class SFPreset(yaml.YAMLObject):
 
     yaml_tag = '!sfpreset'
-    yaml_loader = yaml.SafeLoader
+    yaml_loader = LOADERS
     yaml_dumper = yaml.SafeDumper
 
     def __init__(self, sfont, bank, prog):
@@ -88,7 +400,7 @@ class SFPreset(yaml.YAMLObject):
 class MidiMessage(yaml.YAMLObject):
 
     yaml_tag = '!midimsg'
-    yaml_loader = yaml.SafeLoader
+    yaml_loader = LOADERS
     yaml_dumper = yaml.SafeDumper
 
     def __init__(self, type, chan, par1, par2=None, yaml=''):
@@ -123,7 +435,7 @@ class BankObject(yaml.YAMLObject):
       pars: copy of opars with elements modified as needed
     """
 
-    yaml_loader = yaml.SafeLoader
+    yaml_loader = LOADERS
     yaml_dumper = yaml.SafeDumper
 
     def __init__(self, **pars):
@@ -167,9 +479,19 @@ class RouterRule(BankObject):
         self.pars['par2'] = ParamSpec(pars.get('par2', ''))
 
     def add(self, addfunc):
-        for type in self.type:
-            for chan in self.chan:
-                addfunc(type, chan, **self.pars)
+        """Add the rule using `addfunc` for each type and channel it covers
+
+        Returns: a list of the distinct results of `addfunc`
+        """
+        results = []
+        for type, chan, pars in self.calls():
+            res = addfunc(type, chan, **pars)
+            if res not in results: results.append(res)
+        return results
+
+    def calls(self):
+        """List the (type, chan, pars) fan-out of this rule for Synth.router_addrule"""
+        return [(type, chan, self.pars) for type in self.type for chan in self.chan]
 
     @staticmethod
     def to_yaml(dumper, data):
@@ -246,6 +568,12 @@ class LadspaEffect(BankObject):
         return dumper.represent_mapping('!ladspafx', data)
 
 
+for cls in SFPreset, MidiMessage, RouterRule, Arpeggiator, Sequencer, MidiPlayer, LadspaEffect:
+    Dumper.add_representer(cls, cls.to_yaml)
+for dumper in DUMPERS:
+    dumper.add_representer(PatchBank, lambda dumper, data: dumper.represent_dict(data))
+
+
 class ParamSpec:
     
     def __init__(self, text):
@@ -0,0 +1,131 @@
+"""Sorted index of the files in a directory tree
+
+Scans a directory tree once and keeps the results up to date, so that
+listing banks or soundfonts and stepping through them doesn't touch the
+filesystem each time. On Linux, inotify is used to learn when the tree
+changes; elsewhere directory modification times are checked, at most
+once per polling interval.
+"""
+
+import os
+import sys
+import threading
+import time
+from ctypes import CDLL
+from ctypes.util import find_library
+from pathlib import Path
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_CHANGES = 0x0fc0 # moved from/to, create, delete, delete/move self
+
+try:
+    if not sys.platform.startswith('linux'): raise OSError
+    libc = CDLL(find_library('c'), use_errno=True)
+    libc.inotify_init1, libc.inotify_add_watch
+except (OSError, AttributeError, TypeError):
+    libc = None
+
+
+class FileIndex:
+    """A sorted index of files in a directory tree
+
+    Attributes:
+      root: Path of the top directory
+      suffixes: file extensions to include (lowercase), or None for all files
+      interval: minimum seconds between directory checks when polling
+    """
+
+    def __init__(self, root, suffixes=None, interval=2.0):
+        self.root = Path(root)
+        self.suffixes = [s.lower() for s in suffixes] if suffixes else None
+        self.interval = interval
+        self.lock = threading.RLock()
+        self.fd = None
+        self.lastpoll = 0
+        self._scan()
+
+    @property
+    def files(self):
+        """Sorted list of file Paths relative to `root`"""
+        self.refresh()
+        return self._files
+
+    def position(self, file):
+        """Position of `file` (relative to `root`) in `files`, or None"""
+        self.refresh()
+        return self._pos.get(Path(file), None)
+
+    def step(self, file, inc=1):
+        """Find the file `inc` places from `file` in `files`
+
+        Wraps around at either end. If `file` isn't in the index, the first
+        file is returned.
+
+        Returns: Path relative to `root`, or '' if the index is empty
+        """
+        self.refresh()
+        if not self._files: return ''
+        i = self._pos.get(Path(file), None)
+        return self._files[0 if i == None else (i + inc) % len(self._files)]
+
+    def listdir(self, dir=''):
+        """List the contents of a directory in the index
+
+        Args:
+          dir: directory, absolute or relative to `root`
+
+        Returns: a sorted list of (Path, isdir) tuples for the subdirectories
+          and indexed files in `dir`, with absolute Paths
+        """
+        self.refresh()
+        rel = (self.root / dir).relative_to(self.root)
+        return [(self.root / rel / name, isdir) for name, isdir in self._dirs.get(rel, ((), 0))[0]]
+
+    def refresh(self):
+        """Rescan the tree if it has changed"""
+        with self.lock:
+            if self.fd != None:
+                changed = False
+                try:
+                    while os.read(self.fd, 4096): changed = True
+                except BlockingIOError:
+                    pass
+            else:
+                if time.monotonic() - self.lastpoll < self.interval: return
+                self.lastpoll = time.monotonic()
+                changed = any(self._mtime(self.root / d) != mtime for d, (_, mtime) in self._dirs.items())
+            if changed: self._scan()
+
+    def close(self):
+        """Stop watching for changes"""
+        with self.lock:
+            if self.fd != None:
+                os.close(self.fd)
+                self.fd = None
+
+    def _scan(self):
+        with self.lock:
+            self.close()
+            if libc:
+                fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+                self.fd = fd if fd >= 0 else None
+            files, dirs = [], {}
+            for dirpath, dirnames, filenames in os.walk(self.root):
+                rel = Path(dirpath).relative_to(self.root)
+                if self.fd != None:
+                    libc.inotify_add_watch(self.fd, os.fsencode(dirpath), IN_CHANGES)
+                names = [f for f in filenames if self.suffixes == None or Path(f).suffix.lower() in self.suffixes]
+                files += [rel / f for f in names]
+                entries = sorted([(Path(d), True) for d in dirnames] + [(Path(f), False) for f in names])
+                dirs[rel] = [(p.name, isdir) for p, isdir in entries], self._mtime(Path(dirpath))
+            dirs.setdefault(Path(), ([], self._mtime(self.root)))
+            self._files = sorted(files)
+            self._pos = {f: i for i, f in enumerate(self._files)}
+            self._dirs = dirs
+            self.lastpoll = time.monotonic()
+
+    @staticmethod
+    def _mtime(path):
+        try: return path.stat().st_mtime_ns
+        except OSError: return None
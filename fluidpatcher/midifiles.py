@@ -0,0 +1,138 @@
+"""Standard MIDI files read into memory and indexed
+
+Reads and checks the chunk structure of a standard MIDI file once and
+keeps its bytes, so MIDI players can be fed from memory instead of
+rereading the file each time they're created. The file's time signature
+changes are kept so the bar lines around any tick can be found without
+scanning the file again.
+"""
+
+import struct
+from bisect import bisect_right
+from pathlib import Path
+
+DEFAULT_TIMESIG = 4, 2 # 4/4, denominator as a power of 2
+META_TIMESIG = 0x58
+
+
+class MidiFileError(Exception):
+    pass
+
+
+def _varlen(buf, pos):
+    """read a variable-length quantity, return (value, next position)"""
+    val = 0
+    for _ in range(4):
+        b = buf[pos]
+        pos += 1
+        val = (val << 7) | (b & 0x7f)
+        if b < 0x80: return val, pos
+    raise MidiFileError("variable-length quantity is too long")
+
+
+def _scan_track(buf, pos, end, timesigs):
+    """collect time signature events, return track length in ticks"""
+    tick = 0
+    status = 0
+    while pos < end:
+        delta, pos = _varlen(buf, pos)
+        tick += delta
+        if buf[pos] & 0x80:
+            status = buf[pos]
+            pos += 1
+        elif status == 0:
+            raise MidiFileError("data byte with no running status")
+        if status == 0xff:
+            mtype = buf[pos]
+            size, pos = _varlen(buf, pos + 1)
+            if mtype == META_TIMESIG and size >= 2:
+                timesigs.append((tick, buf[pos], buf[pos + 1]))
+            elif mtype == 0x2f:
+                return tick
+            pos += size
+            status = 0
+        elif status in (0xf0, 0xf7):
+            size, pos = _varlen(buf, pos)
+            pos += size
+            status = 0
+        elif 0xc0 <= status < 0xe0: pos += 1
+        else: pos += 2
+    if pos > end:
+        raise MidiFileError("track ends in the middle of an event")
+    return tick
+
+
+class MidiFile:
+    """A standard MIDI file held in memory
+
+    Bar lines are worked out from the time signatures as they're needed.
+    A time signature change takes effect at the first bar line at or
+    after it, and bars continue past the end of the file.
+
+    Attributes:
+      data: the file's bytes
+      format: SMF format, 0-2
+      division: ticks per quarter note, or None for SMPTE timing
+      length: length of the longest track in ticks
+    """
+
+    def __init__(self, data):
+        self.data = bytes(data)
+        buf = memoryview(self.data)
+        if buf[:4] != b'MThd' or len(buf) < 14:
+            raise MidiFileError("not a standard MIDI file")
+        hsize, self.format, ntracks, division = struct.unpack_from('>IHHH', buf, 4)
+        if hsize < 6 or self.format > 2 or division in (0, 0x8000):
+            raise MidiFileError("unsupported MIDI file header")
+        self.division = None if division & 0x8000 else division
+        timesigs = []
+        self.length = 0
+        pos = 8 + hsize
+        for _ in range(ntracks):
+            if pos + 8 > len(buf):
+                raise MidiFileError(f"file has fewer than {ntracks} tracks")
+            cid, size = struct.unpack_from('>4sI', buf, pos)
+            if pos + 8 + size > len(buf):
+                raise MidiFileError("track chunk is truncated")
+            if cid == b'MTrk':
+                try: tick = _scan_track(buf, pos + 8, pos + 8 + size, timesigs)
+                except IndexError:
+                    raise MidiFileError("track chunk is truncated") from None
+                self.length = max(self.length, tick)
+            pos += 8 + size
+        # (first bar line, ticks per bar) of each stretch of bars of one length
+        self._barstarts, self._barsizes = [], []
+        if self.division:
+            self._barstarts.append(0)
+            self._barsizes.append(self._barticks(*DEFAULT_TIMESIG))
+            for start, nn, dd in sorted(timesigs, key=lambda t: t[0]):
+                first, size = self._barstarts[-1], self._barsizes[-1]
+                tick = max(first - (first - start) // size * size, first)
+                if tick == first: self._barsizes[-1] = self._barticks(nn, dd)
+                else:
+                    self._barstarts.append(tick)
+                    self._barsizes.append(self._barticks(nn, dd))
+
+    def nextbar(self, tick):
+        """tick of the first bar line after a tick, or None for SMPTE timing"""
+        if not self._barstarts: return None
+        i = bisect_right(self._barstarts, tick) - 1
+        first, size = self._barstarts[i], self._barsizes[i]
+        return first + ((tick - first) // size + 1) * size
+
+    def _barticks(self, nn, dd):
+        return max(int(self.division * 4 * nn / 2 ** dd), 1)
+
+
+def read_midifile(path):
+    """Read a MIDI file into memory and index it
+
+    Args:
+      path: path to a standard MIDI file
+
+    Returns: a MidiFile
+
+    Raises: OSError if the file can't be read, MidiFileError if it
+      isn't a valid standard MIDI file
+    """
+    return MidiFile(Path(path).read_bytes())
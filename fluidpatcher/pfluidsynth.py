@@ -1,5 +1,17 @@
 """ctypes bindings and interface classes for fluidsynth
 """
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from functools import reduce
+from heapq import heappush, heappop
+try: from math import lcm
+except ImportError: # python < 3.9
+    from math import gcd
+    def lcm(*ints): return reduce(lambda a, b: a * b // gcd(a, b), ints, 1)
 from ctypes.util import find_library
 from ctypes import *
 
@@ -17,11 +29,22 @@ FLUID_PLAYER_PLAYING = 1
 FLUID_PLAYER_DONE = 3
 MIDI_TYPES = {'note': 0x90, 'cc': 0xb0, 'prog': 0xc0, 'pbend': 0xe0, 'cpress': 0xd0, 'kpress': 0xa0, 'noteoff': 0x80,
               'clock': 0xf8, 'start': 0xfa, 'continue': 0xfb, 'stop': 0xfc}
+MIDI_TYPECODES = {v: k for k, v in MIDI_TYPES.items()}
 MIDI_VOICE_2PAR = 'note', 'cc', 'kpress', 'noteoff'
 MIDI_VOICE_1PAR = 'prog', 'pbend', 'cpress'
 MIDI_REALTIME = 'clock', 'start', 'continue', 'stop'
+NATIVE_RULE_TYPES = 'note', 'cc', 'prog', 'pbend', 'cpress', 'kpress' # fluid_midi_router_rule_type order
 SEEK_DONE = -1
 SEEK_WAIT = -2
+EVENT_POOL_SIZE = 16
+SIGNAL_QUEUE_SIZE = 256
+PLAYER_SOURCE_IDS = 0x4000 # sources for sequencer note events, clear of real client ids
+TRANSPORT_CALL = 1 # timer data for the transport's deferred calls
+SIGNAL_OVERFLOW = 'drop-oldest', 'coalesce', 'block'
+SIGNAL_COALESCE = 'cc', 'pbend', 'cpress', 'kpress'
+STATS_BINS = 25e-6, 50e-6, 100e-6, 250e-6, 500e-6, 1e-3, 2.5e-3, 5e-3, 10e-3
+RULE_ACTIONS = 'fluidsetting', 'sequencer', 'arpeggiator', 'midiplayer', 'tempo', 'sync', 'ladspafx'
+RULE_BASEPARS = frozenset(('hastype', 'newtype', 'chan', 'par1', 'par2'))
 
 fslib = find_library('fluidsynth') or find_library('libfluidsynth-3')
 if fslib is None:
@@ -87,6 +110,7 @@ def fl_midi_router_rule_set_param2(rule, min, max, mul, add):
 
 # midi events
 specfunc(FS.new_fluid_midi_event, c_void_p)
+specfunc(FS.delete_fluid_midi_event, None, c_void_p)
 specfunc(FS.delete_fluid_event, None, c_void_p)
 specfunc(FS.fluid_midi_event_get_type, c_int, c_void_p)
 specfunc(FS.fluid_midi_event_get_channel, c_int, c_void_p)
@@ -109,6 +133,7 @@ specfunc(FS.fluid_event_set_source, None, c_void_p, c_void_p)
 specfunc(FS.fluid_event_set_dest, None, c_void_p, c_void_p)
 specfunc(FS.fluid_event_timer, None, c_void_p, c_void_p)
 specfunc(FS.fluid_event_get_type, c_int, c_void_p)
+specfunc(FS.fluid_event_get_data, c_void_p, c_void_p)
 def fl_event_noteon(event, chan, key, vel): FS.fluid_event_noteon(event, chan - 1, key, vel)
 def fl_event_noteoff(event, chan, key): FS.fluid_event_noteoff(event, chan - 1, key)
 
@@ -129,6 +154,7 @@ fl_tickcallback = CFUNCTYPE(None, c_void_p, c_uint)
 specfunc(FS.new_fluid_player, c_void_p, c_void_p)
 specfunc(FS.delete_fluid_player, None, c_void_p)
 specfunc(FS.fluid_player_add, c_int, c_void_p, c_char_p)
+specfunc(FS.fluid_player_add_mem, c_int, c_void_p, c_char_p, c_size_t)
 specfunc(FS.fluid_player_set_playback_callback, c_int, c_void_p, fl_eventcallback, c_void_p)
 specfunc(FS.fluid_player_set_tick_callback, c_int, c_void_p, fl_tickcallback, c_void_p)
 specfunc(FS.fluid_player_set_tempo, c_int, c_void_p, c_int, c_double)
@@ -156,37 +182,78 @@ except AttributeError:
 
 
 class MidiEvent:
+    """A MIDI event decoded once from a fluid_midi_event
 
-    def __init__(self, event):
-        self.event = event
+    Reading a fluid_midi_event's fields crosses the ctypes boundary
+    each time, so incoming events are decoded into one of these and
+    passed around the router instead. encode() writes the fields back
+    into a fluid_midi_event for sending.
+    """
 
-    @property
-    def type(self):
-        b = FS.fluid_midi_event_get_type(self.event)
-        if b == 0x90 and self.par2 == 0: b = 0x80
-        return {v: k for k, v in MIDI_TYPES.items()}.get(b, None)
-    @type.setter
-    def type(self, n):
-        n = MIDI_TYPES.get(n, None)
-        FS.fluid_midi_event_set_type(self.event, n)
+    __slots__ = 'type', 'chan', 'par1', 'par2'
 
-    @property
-    def chan(self): return fl_midi_event_get_channel(self.event)
-    @chan.setter
-    def chan(self, v): fl_midi_event_set_channel(self.event, v)
-    
-    @property
-    def par1(self): return fl_midi_event_get_par1(self.event)
-    @par1.setter
-    def par1(self, v): fl_midi_event_set_par1(self.event, v)
+    def __init__(self, type, chan, par1, par2=None):
+        self.type = type
+        self.chan = chan
+        self.par1 = par1
+        self.par2 = par2
+
+    @classmethod
+    def decode(cls, event):
+        b = FS.fluid_midi_event_get_type(event)
+        par2 = fl_midi_event_get_par2(event)
+        if b == 0x90 and par2 == 0: b = 0x80
+        return cls(MIDI_TYPECODES.get(b, None), fl_midi_event_get_channel(event),
+                   fl_midi_event_get_par1(event), par2)
+
+    def encode(self, event):
+        FS.fluid_midi_event_set_type(event, MIDI_TYPES.get(self.type, None))
+        fl_midi_event_set_channel(event, self.chan)
+        fl_midi_event_set_par1(event, self.par1)
+        fl_midi_event_set_par2(event, self.par2 or 0)
+        return event
 
-    @property
-    def par2(self): return fl_midi_event_get_par2(self.event)
-    @par2.setter
-    def par2(self, v): fl_midi_event_set_par2(self.event, v)
-    
     def __repr__(self):
-        return "type: %s, chan: %d, par1: %d, par2: %d" % (self.type, self.chan, self.par1, self.par2)
+        return "type: %s, chan: %d, par1: %d, par2: %d" % (self.type, self.chan, self.par1, self.par2 or 0)
+
+
+class MidiEventPool:
+    """A bounded pool of reusable fluid_midi_events
+
+    Events are taken with acquire() and must be given back with release()
+    once they have been dispatched - fluidsynth handles events synchronously
+    so this can be done as soon as the handler returns. If the pool is empty
+    a new event is allocated (a miss), and events released into a full pool
+    are deleted, so the pool never holds more than `size` events.
+    """
+
+    def __init__(self, size=EVENT_POOL_SIZE):
+        self.size = size
+        self.free = deque(FS.new_fluid_midi_event() for _ in range(size))
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self):
+        try:
+            event = self.free.pop()
+        except IndexError:
+            self.misses += 1
+            return FS.new_fluid_midi_event()
+        self.hits += 1
+        return event
+
+    def release(self, event):
+        if len(self.free) < self.size:
+            self.free.append(event)
+        else:
+            FS.delete_fluid_midi_event(event)
+
+    def stats(self):
+        return dict(size=self.size, free=len(self.free), hits=self.hits, misses=self.misses)
+
+    def close(self):
+        while self.free:
+            FS.delete_fluid_midi_event(self.free.pop())
 
 
 class Route:
@@ -197,6 +264,14 @@ class Route:
         self.mul = mul
         self.add = add
 
+    def __repr__(self):
+        return f"{self.min}-{self.max}*{self.mul}+{self.add}"
+
+    def __contains__(self, val):
+        if self.min > self.max:
+            return not (self.min < val < self.max)
+        return self.min <= val <= self.max
+
 
 class CustomRule:
 
@@ -216,32 +291,42 @@ class CustomRule:
     def __iter__(self):
         return iter(self.__dict__)
 
+    def __contains__(self, key):
+        return key in self.__dict__
+
+    def action(self):
+        for act in RULE_ACTIONS:
+            if act in self.__dict__:
+                if act == 'ladspafx' and not LADSPA_SUPPORT: break
+                return act
+        return None
+
+    def params(self):
+        return frozenset(self.__dict__) - RULE_BASEPARS
+
     def applies(self, mevent):
         if self.hastype != mevent.type:
             return False
         if self.hastype in MIDI_REALTIME:
             return True
-        if self.chan != None:
-            if self.chan.min > self.chan.max:
-                if self.chan.min < mevent.chan < self.chan.max:
-                    return False
-            else:
-                if not (self.chan.min <= mevent.chan <= self.chan.max):
-                    return False
-        if self.par1 != None:
-            if self.par1.min > self.par1.max:
-                if self.par1.min < mevent.par1 < self.par1.max:
-                    return False
-            else:
-                if not (self.par1.min <= mevent.par1 <= self.par1.max):
-                    return False
+        if self.chan != None and mevent.chan not in self.chan:
+            return False
+        if self.par1 != None and mevent.par1 not in self.par1:
+            return False
         if self.hastype in MIDI_VOICE_2PAR and self.par2 != None:
-            if self.par2.min > self.par2.max:
-                if self.par2.min < mevent.par2 < self.par2.max:
-                    return False
-            else:
-                if not (self.par2.min <= mevent.par2 <= self.par2.max):
-                    return False
+            if mevent.par2 not in self.par2:
+                return False
+        return True
+
+    def indexable(self, type, chan, par1):
+        if self.hastype != type:
+            return False
+        if self.hastype in MIDI_REALTIME:
+            return True
+        if self.chan != None and chan not in self.chan:
+            return False
+        if self.par1 != None and par1 != None and par1 not in self.par1:
+            return False
         return True
 
     def apply(self, mevent):
@@ -269,12 +354,11 @@ class TransRule(CustomRule):
     def __init__(self, type, chan, par1, par2):
         super().__init__(type, chan, par1, par2)
 
+    def action(self):
+        return 'transform'
+
     def apply(self, mevent):
-        newevent = MidiEvent(FS.new_fluid_midi_event())
-        newevent.type = self.newtype
-        newevent.chan = mevent.chan
-        newevent.par1 = mevent.par1
-        newevent.par2 = mevent.par2
+        newevent = MidiEvent(self.newtype, mevent.chan, mevent.par1, mevent.par2)
         if self.hastype in MIDI_REALTIME:
             if self.chan != None: newevent.chan = self.chan.min
             if self.par1 != None: newevent.par1 = self.par1.min
@@ -298,6 +382,74 @@ class TransRule(CustomRule):
         return newevent
 
 
+class RuleIndex:
+    """Custom router rules in router order, bucketed by what they match
+
+    Candidate rules for an event are found by (type, channel, par1) and
+    cached on first use, so a rule list is only scanned once per bucket
+    rather than once per event. Values of par1 above 127 (i.e. pitch bend)
+    share a single bucket per channel. Rule order is preserved within
+    each bucket. Buckets hold (rule, action, params) tuples, where
+    `action` is what the Synth does with the rule (None if the rule
+    is for the callback) and `params` are its extra parameter names.
+    The index is immutable - adding or clearing rules replaces it
+    with a new one.
+    """
+
+    def __init__(self, entries=()):
+        self.entries = tuple(entries)
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return (rule for rule, _, _ in self.entries)
+
+    def insert(self, *rules):
+        return RuleIndex((*[(r, r.action(), r.params()) for r in rules], *self.entries))
+
+    def candidates(self, type, chan, par1):
+        if type in MIDI_REALTIME:
+            key = type, 0, 0
+        else:
+            key = type, chan, par1 if 0 <= par1 < 128 else None
+        try:
+            return self.buckets[key]
+        except KeyError:
+            entries = tuple(e for e in self.entries if e[0].indexable(*key))
+            self.buckets[key] = entries
+            return entries
+
+
+class Subscription:
+    """Describes which MidiSignals a midi_callback wants
+
+    Each of `types`, `chans`, and `rules` is a collection of values to
+    accept, or None to accept anything. `types` and `chans` filter the
+    signals sent for incoming events - channels are ignored for system
+    realtime messages. `rules` filters signals from custom router rules,
+    accepting a rule if it has any of the listed parameters (e.g. `patch`).
+    """
+
+    __slots__ = 'types', 'chans', 'rules'
+
+    def __init__(self, types=None, chans=None, rules=None):
+        self.types = None if types == None else frozenset(types)
+        self.chans = None if chans == None else frozenset(chans)
+        self.rules = None if rules == None else frozenset(rules)
+
+    def wants_event(self, type, chan):
+        if self.types != None and type not in self.types:
+            return False
+        if self.chans != None and type not in MIDI_REALTIME and chan not in self.chans:
+            return False
+        return True
+
+    def wants_rule(self, params):
+        return self.rules == None or not self.rules.isdisjoint(params)
+
+
 class MidiSignal:
 
     def __init__(self, mevent, rule=None):
@@ -313,147 +465,525 @@ class MidiSignal:
     def __iter__(self):
         return iter(self.__dict__)
 
+    def __contains__(self, key):
+        return key in self.__dict__
+
+
+class SignalQueue:
+    """Hands MidiSignals off to a dispatcher thread
+
+    The MIDI driver thread put()s signals into a bounded deque, and a daemon
+    thread passes them to `callback` in order, so slow callbacks don't delay
+    routing of later events. When the queue is full the `overflow` policy
+    decides what happens to a new signal:
+
+    - `drop-oldest`: discard the oldest queued signal
+    - `coalesce`: replace a queued signal with the same key (e.g. the same
+        controller on the same channel) if there is one, otherwise drop oldest
+    - `block`: wait for the dispatcher to make room. Signals put from the
+        dispatcher thread itself never block, since that would deadlock
+
+    Only `block` takes a lock on the producer side. Call stop() to shut
+    the thread down.
+    """
+
+    def __init__(self, callback, size=SIGNAL_QUEUE_SIZE, overflow='drop-oldest'):
+        if overflow not in SIGNAL_OVERFLOW:
+            raise ValueError(f"Unknown signal overflow policy '{overflow}'")
+        self.callback = callback
+        self.size = size
+        self.overflow = overflow
+        self.queue = deque()
+        self.wake = threading.Event()
+        self.space = threading.Condition()
+        self.maxdepth = self.dispatched = self.dropped = self.coalesced = self.blocked = 0
+        self.lag = self.maxlag = self.totallag = 0.0
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='midisignals', daemon=True)
+        self.thread.start()
+
+    def put(self, sig, key=None):
+        if not self.running: return
+        q = self.queue
+        if len(q) >= self.size:
+            if self.overflow == 'block' and threading.current_thread() is not self.thread:
+                self.blocked += 1
+                with self.space:
+                    while len(q) >= self.size:
+                        self.space.wait()
+            elif self.overflow == 'coalesce' and key != None and self._coalesce(sig, key):
+                return
+            else:
+                try: q.popleft()
+                except IndexError: pass
+                else: self.dropped += 1
+        q.append([time.perf_counter(), key, sig])
+        if len(q) > self.maxdepth: self.maxdepth = len(q)
+        self.wake.set()
+
+    def run(self):
+        q = self.queue
+        while self.running:
+            self.wake.wait()
+            self.wake.clear()
+            while q and self.running:
+                try: t, _, sig = q.popleft()
+                except IndexError: break
+                if self.overflow == 'block':
+                    with self.space: self.space.notify()
+                self.lag = time.perf_counter() - t
+                self.maxlag = max(self.maxlag, self.lag)
+                self.totallag += self.lag
+                self.dispatched += 1
+                try: self.callback(sig)
+                except Exception: sys.excepthook(*sys.exc_info())
+
+    def stop(self, timeout=None):
+        """Stop the dispatcher thread, discarding any queued signals"""
+        self.running = False
+        self.queue.clear()
+        with self.space: self.space.notify_all()
+        self.wake.set()
+        if threading.current_thread() is not self.thread:
+            self.thread.join(timeout)
+
+    def stats(self):
+        return dict(depth=len(self.queue), maxdepth=self.maxdepth, size=self.size,
+                    overflow=self.overflow, dispatched=self.dispatched, dropped=self.dropped,
+                    coalesced=self.coalesced, blocked=self.blocked, lag=self.lag, maxlag=self.maxlag,
+                    meanlag=self.totallag / self.dispatched if self.dispatched else 0.0)
+
+    def _coalesce(self, sig, key):
+        for item in reversed(self.queue):
+            if item[1] == key:
+                item[2] = sig
+                self.coalesced += 1
+                return True
+        return False
+
+
+class RouterStats:
+    """Counters and timings for custom_midi_router and midi_callback
+
+    For each custom rule, counts how many events were checked against it,
+    how many it matched, and how many times it was applied (rules meant
+    for the callback aren't applied if they aren't subscribed to). Times
+    spent routing each event and in each midi_callback call are collected
+    in histograms whose bins have the upper edges in STATS_BINS, plus an
+    overflow bin.
+    """
+
+    def __init__(self):
+        self.rules = {}
+        self.routetimes = [0] * (len(STATS_BINS) + 1)
+        self.callbacktimes = [0] * (len(STATS_BINS) + 1)
+        self.routemax = self.routetotal = 0.0
+        self.callbackmax = self.callbacktotal = 0.0
+
+    def count(self, rule, i):
+        try:
+            self.rules[id(rule)][i] += 1
+        except KeyError:
+            self.rules[id(rule)] = [rule, 0, 0, 0]
+            self.rules[id(rule)][i] += 1
+
+    def route_time(self, dt):
+        self.routetimes[bisect_left(STATS_BINS, dt)] += 1
+        self.routetotal += dt
+        if dt > self.routemax: self.routemax = dt
+
+    def callback_time(self, dt):
+        self.callbacktimes[bisect_left(STATS_BINS, dt)] += 1
+        self.callbacktotal += dt
+        if dt > self.callbackmax: self.callbackmax = dt
+
+    def snapshot(self):
+        def hist(counts, total, maxtime):
+            n = sum(counts)
+            return dict(count=n, bins=STATS_BINS, counts=list(counts), max=maxtime,
+                        mean=total / n if n else 0.0)
+        rules = [dict(rule=repr(r), checked=c, matched=m, applied=a) for r, c, m, a in self.rules.values()]
+        return dict(rules=sorted(rules, key=lambda r: r['checked'], reverse=True),
+                    router=hist(self.routetimes, self.routetotal, self.routemax),
+                    callback=hist(self.callbacktimes, self.callbacktotal, self.callbackmax))
+
+
+class Transport:
+    """Shared clock that drives all sequencers and arpeggiators
+
+    Owns a single fluid sequencer client. While any sequencer is playing,
+    a timer wakes the transport once per bar at the master tempo, and the
+    upcoming steps of every playing sequencer are queued in one pass.
+    Work can also be deferred to the sequencer's thread with call().
+    Setting the master tempo sets the tempo of all registered players,
+    including MIDI players.
+
+    Attributes:
+      tempo: master tempo in beats per minute
+      players: registered players
+    """
+
+    def __init__(self, synth):
+        self.fseq = synth.fseq
+        self.fsynth_id = synth.fsynth_id
+        self.callback = fl_seqcallback(self.scheduler)
+        self.client_id = FS.fluid_sequencer_register_client(self.fseq, b'transport', self.callback, None)
+        self.players = []
+        self.tempo = 120
+        self.ticksperbeat = 500 # default 120bpm at 1000 ticks/sec
+        self.origin = (0, 0) # (tick, beats) when the tempo last changed
+        self.wake = None # tick of the next timer, or None if stopped
+        self.calls = deque()
+        self.sources = {} # source id of each registered player
+        self.freesources = [] # ids of removed players, reused so ids stay in range
+
+    @property
+    def position(self):
+        """(bar, beat) of the transport, counted from zero at 4 beats per bar"""
+        tick, beats = self.origin
+        beats += (FS.fluid_sequencer_get_tick(self.fseq) - tick) / self.ticksperbeat
+        return int(beats // 4), beats % 4
+
+    def add(self, player):
+        """Register a player and return a source id for its events"""
+        self.players.append(player)
+        if self.freesources: source = heappop(self.freesources)
+        else: source = PLAYER_SOURCE_IDS + len(self.sources) + 1
+        self.sources[player] = source
+        return source
+
+    def remove(self, player):
+        """Unregister a player, its events must already have been removed"""
+        if player in self.players:
+            self.players.remove(player)
+            heappush(self.freesources, self.sources.pop(player))
 
-class SequencerNote:
+    def set_tempo(self, bpm):
+        """Set the master tempo and the tempo of all players"""
+        now = FS.fluid_sequencer_get_tick(self.fseq)
+        tick, beats = self.origin
+        self.origin = now, beats + (now - tick) / self.ticksperbeat
+        self.tempo = bpm
+        # default fluid_sequencer time scale is 1000 ticks per second
+        self.ticksperbeat = 1000 * 60 / bpm
+        for player in self.players:
+            player.set_tempo(bpm)
 
-    def __init__(self, chan, key, vel):
-        self.chan = chan
-        self.key = key
-        self.vel = vel
-        
-    def __iter__(self):
-        return iter([self])
+    def queue(self, player):
+        """Queue a player's steps through the next wakeup, starting the timer if needed"""
+        if self.wake == None:
+            self.wake = FS.fluid_sequencer_get_tick(self.fseq) + 4 * self.ticksperbeat
+            self._timer(self.wake)
+        player.fill(self.wake)
 
-    def schedule(self, seq, timeon, timeoff, accent=1):
-        evt = FS.new_fluid_event()
-        FS.fluid_event_set_source(evt, -1)
-        FS.fluid_event_set_dest(evt, seq.fsynth_id)
-        fl_event_noteon(evt, self.chan, self.key, int(min(self.vel * accent, 127)))
-        FS.fluid_sequencer_send_at(seq.fseq, evt, int(timeon), 1)
-        FS.delete_fluid_event(evt)
+    def call(self, func):
+        """Call a function from the sequencer's thread as soon as possible"""
+        self.calls.append(func)
+        self._timer(FS.fluid_sequencer_get_tick(self.fseq), TRANSPORT_CALL)
+
+    def scheduler(self, time=None, event=None, fseq=None, data=None):
+        if event and FS.fluid_event_get_type(event) == FLUID_SEQ_UNREGISTERING:
+            return
+        if event and FS.fluid_event_get_data(event) == TRANSPORT_CALL:
+            while self.calls:
+                self.calls.popleft()()
+            return
+        playing = [p for p in self.players if isinstance(p, Sequencer) and p.playing]
+        if not playing:
+            self.wake = None
+            return
+        self.wake += 4 * self.ticksperbeat
+        self._timer(self.wake)
+        for player in playing:
+            player.fill(self.wake)
+
+    def _timer(self, time, data=None):
         evt = FS.new_fluid_event()
         FS.fluid_event_set_source(evt, -1)
-        FS.fluid_event_set_dest(evt, seq.fsynth_id)
-        fl_event_noteoff(evt, int(self.chan), int(self.key))
-        FS.fluid_sequencer_send_at(seq.fseq, evt, int(timeoff), 1)
+        FS.fluid_event_set_dest(evt, self.client_id)
+        FS.fluid_event_timer(evt, data)
+        FS.fluid_sequencer_send_at(self.fseq, evt, int(time), 1)
         FS.delete_fluid_event(evt)
 
 
 class Sequencer:
-
-    def __init__(self, synth, notes, tdiv, swing, groove):
+    """Plays a looped pattern of notes
+
+    The pattern is compiled into arrays of step times and note
+    durations, channels, keys, and velocities, with swing and groove
+    already applied. Changing the tempo or notes only marks the arrays
+    stale, and they're compiled again when steps are next queued. Steps
+    are queued by the synth's Transport in slices from these arrays,
+    through its next wakeup plus half of `lookahead` bars for slack. Note
+    events are sent with a source id unique to the sequencer, so steps
+    that haven't started can be removed and queued again when the tempo
+    or pattern changes.
+    """
+
+    def __init__(self, synth, notes, tdiv, swing, groove, lookahead=1):
         self.fseq = synth.fseq
         self.fsynth_id = synth.fsynth_id
-        self.callback = fl_seqcallback(self.scheduler)
-        self.seq_id = FS.fluid_sequencer_register_client(self.fseq, b'seq', self.callback, None)
-        self.notes = [SequencerNote(chan, key, vel) for _, chan, key, vel in notes]
+        self.transport = synth.transport
+        self.source = self.transport.add(self)
+        self.notes = [((chan, key, vel),) for _, chan, key, vel in notes]
         self.tdiv = tdiv
         self.swing = swing
         self.groove = groove
+        self.lookahead = lookahead
         self.ticksperbeat = 500 # default 120bpm at 1000 ticks/sec
         self.beat = 0
+        self.loop = 0
+        self.nextnote = 0
+        self.chunks = [] # (start, first step, end step, beat, loop) of queued slices
+        self.sounding = [] # (timeon, timeoff, chan, key) of notes whose noteoffs were resent
+        self._compile()
 
-    def scheduler(self, time=None, event=None, fseq=None, data=None):
-        if event and FS.fluid_event_get_type(event) == FLUID_SEQ_UNREGISTERING:
-            return
-        if not self.notes: return
-        dur = self.ticksperbeat * 4 / self.tdiv
-        if self.tdiv >= 8 and self.tdiv % 3:
-            if self.beat % 2: dur *= 2 * (1 - self.swing)
-            else: dur *= 2 * self.swing
-        pos = self.beat % len(self.notes)
-        accent = self.groove[self.beat % len(self.groove)]
-        for note in self.notes[pos]:
-            note.schedule(self, self.nextnote, self.nextnote + dur, accent)
-        if pos == len(self.notes) - 1:
-            self.loop -= 1
-        if self.loop != 0:
-            self.timer(self.nextnote + 0.99 * dur)
-            self.nextnote += dur
-            self.beat += 1
+    @property
+    def playing(self):
+        return self.loop != 0 and len(self.notes) > 0
+
+    def fill(self, wake):
+        """Queue the steps that start before the transport's next wakeup, plus slack"""
+        # chunks were cleared when the pattern or tempo changed, so nothing refers to the old arrays
+        if not self.compiled: self._compile()
+        if not self.period: return
+        now = FS.fluid_sequencer_get_tick(self.fseq)
+        self.chunks = [c for c in self.chunks if c[0] + self.stepticks[c[2]] > now]
+        horizon = wake + self.ticksperbeat * 2 * self.lookahead
+        n = self.nsteps
+        evt = self._event()
+        while self.loop != 0 and self.nextnote < horizon:
+            # slice the compiled cycle from the current step up to the horizon
+            i = self.beat % self.period
+            start = self.nextnote - self.stepticks[i]
+            j = bisect_left(self.stepticks, horizon - start, i, self.period)
+            if self.loop > 0: j = min(j, i + self.loop * n - self.beat % n)
+            self.chunks.append((start, i, j, self.beat, self.loop))
+            for k in range(self.firstnote[i], self.firstnote[j]):
+                timeon = start + self.noteticks[k]
+                fl_event_noteon(evt, self.notechans[k], self.notekeys[k], self.notevels[k])
+                FS.fluid_sequencer_send_at(self.fseq, evt, int(timeon), 1)
+                fl_event_noteoff(evt, self.notechans[k], self.notekeys[k])
+                FS.fluid_sequencer_send_at(self.fseq, evt, int(timeon + self.notedurs[k]), 1)
+            self.loop -= (self.beat % n + j - i) // n
+            self.beat += j - i
+            self.nextnote = start + self.stepticks[j]
+        FS.delete_fluid_event(evt)
 
     def play(self, loops=1):
-        FS.fluid_sequencer_remove_events(self.fseq, -1, self.seq_id, FLUID_SEQ_TIMER)
+        now = self._cancel()
+        self.chunks = []
+        self.loop = loops
         if loops != 0:
-            self.loop = loops
             self.beat = 0
-            self.nextnote = FS.fluid_sequencer_get_tick(self.fseq)
-            self.scheduler()
-            
-    def timer(self, time):
-        evt = FS.new_fluid_event()
-        FS.fluid_event_set_source(evt, -1)
-        FS.fluid_event_set_dest(evt, self.seq_id)
-        FS.fluid_event_timer(evt, None)
-        FS.fluid_sequencer_send_at(self.fseq, evt, int(time), 1)
-        FS.delete_fluid_event(evt)
+            self.nextnote = now
+            self.transport.queue(self)
+
+    def requeue(self):
+        """Remove steps that haven't started yet and queue them again"""
+        now = self._cancel()
+        for start, i, j, beat, loop in self.chunks:
+            if start + self.stepticks[j - 1] > now:
+                k = bisect_right(self.stepticks, now - start, i, j)
+                self.nextnote = start + self.stepticks[k]
+                self.beat = beat + k - i
+                self.loop = loop - (beat % self.nsteps + k - i) // self.nsteps
+                break
+        self.chunks = []
+        if self.playing:
+            self.transport.queue(self)
 
     def set_tempo(self, bpm):
         # default fluid_sequencer time scale is 1000 ticks per second
         self.ticksperbeat = 1000 * 60 / bpm
+        self.compiled = False
+        self.requeue()
 
     def dismiss(self):
         self.notes = []
+        self.compiled = False
         self.play(0)
-        FS.fluid_sequencer_unregister_client(self.fseq, self.seq_id)
 
+    def _compile(self):
+        # steps repeat when the pattern, groove, and swing all line up
+        self.nsteps = len(self.notes)
+        self.period = lcm(self.nsteps, len(self.groove), 2) if self.notes else 0
+        self.stepticks = array('d', [0])
+        self.firstnote = array('L', [0])
+        self.noteticks, self.notedurs = array('d'), array('d')
+        self.notechans, self.notekeys, self.notevels = array('H'), array('H'), array('B')
+        for beat in range(self.period):
+            dur = self.ticksperbeat * 4 / self.tdiv
+            if self.tdiv >= 8 and self.tdiv % 3:
+                if beat % 2: dur *= 2 * (1 - self.swing)
+                else: dur *= 2 * self.swing
+            accent = self.groove[beat % len(self.groove)]
+            for chan, key, vel in self.notes[beat % self.nsteps]:
+                self.noteticks.append(self.stepticks[-1])
+                self.notedurs.append(dur)
+                self.notechans.append(chan)
+                self.notekeys.append(key)
+                self.notevels.append(int(min(vel * accent, 127)))
+            self.firstnote.append(len(self.notekeys))
+            self.stepticks.append(self.stepticks[-1] + dur)
+        self.compiled = True
+
+    def _event(self):
+        evt = FS.new_fluid_event()
+        FS.fluid_event_set_source(evt, self.source)
+        FS.fluid_event_set_dest(evt, self.fsynth_id)
+        return evt
+
+    def _cancel(self):
+        now = FS.fluid_sequencer_get_tick(self.fseq)
+        FS.fluid_sequencer_remove_events(self.fseq, self.source, -1, -1)
+        # notes that have started still need their noteoffs
+        self.sounding = [note for note in self.sounding if note[0] <= now < note[1]]
+        for start, i, j, _, _ in self.chunks:
+            started = bisect_right(self.stepticks, now - start, i, j)
+            for k in range(self.firstnote[i], self.firstnote[started]):
+                timeon = start + self.noteticks[k]
+                if now < timeon + self.notedurs[k]:
+                    self.sounding.append((timeon, timeon + self.notedurs[k], self.notechans[k], self.notekeys[k]))
+        evt = self._event()
+        for _, timeoff, chan, key in self.sounding:
+            fl_event_noteoff(evt, chan, key)
+            FS.fluid_sequencer_send_at(self.fseq, evt, int(timeoff), 1)
+        FS.delete_fluid_event(evt)
+        return now
 
-class Arpeggiator(Sequencer):
 
-    def __init__(self, synth, tdiv, swing, groove, style, octaves):
-        super().__init__(synth, [], tdiv, swing, groove)
+class HeldNotes:
+    """Keys held down on an arpeggiator, viewed as its pattern of steps
+
+    The held keys are kept in compact arrays, sorted by key unless the
+    style plays them in the order they were pressed, and are updated in
+    place as keys are pressed and released. Indexing gives the notes of
+    a step in the arpeggiator's style and octave range, so the pattern
+    is never rebuilt.
+    """
+
+    def __init__(self, style, octaves):
         self.style = style
         self.octaves = octaves
-        self.keysdown = []
+        self.sorted = style in ('up', 'down', 'both')
+        self.keys = array('B')
+        self.chans = array('H')
+        self.vels = array('f')
+
+    def press(self, chan, key, vel):
+        key, chan = int(key), int(chan)
+        i = bisect_right(self.keys, key) if self.sorted else len(self.keys)
+        self.keys.insert(i, key)
+        self.chans.insert(i, chan)
+        self.vels.insert(i, vel)
+
+    def release(self, key):
+        if self.sorted:
+            i = bisect_left(self.keys, key)
+            if i == len(self.keys) or self.keys[i] != key: return
+        elif key in self.keys: i = self.keys.index(key)
+        else: return
+        del self.keys[i], self.chans[i], self.vels[i]
+
+    def __len__(self):
+        n = len(self.keys) * self.octaves
+        if self.style == 'chord': return min(n, 1)
+        if self.style == 'both' and n > 1: return 2 * n - 2
+        return n
+
+    def __getitem__(self, pos):
+        n = len(self.keys) * self.octaves
+        if self.style == 'chord':
+            return [self._note(i) for i in range(n)]
+        if pos >= n: pos = 2 * n - 2 - pos
+        if self.style == 'down': pos = n - 1 - pos
+        return self._note(pos),
+
+    def _note(self, i):
+        octave, i = divmod(i, len(self.keys))
+        return self.chans[i], self.keys[i] + octave * 12, self.vels[i]
+
+
+class Arpeggiator(Sequencer):
+    """Plays the keys held down on it as a pattern
+
+    Key presses and releases are only recorded by note(), and applied
+    on the sequencer's thread through the transport, so the pattern is
+    compiled and queued there once per batch of keys rather than in
+    the MIDI thread for each key.
+    """
+
+    def __init__(self, synth, tdiv, swing, groove, style, octaves, lookahead=1):
+        super().__init__(synth, [], tdiv, swing, groove, lookahead)
+        self.style = style
+        self.notes = HeldNotes(style, octaves)
+        self.compiled = False
+        self.keyevents = deque()
 
     def note(self, chan, key, vel):
-        if vel > 0:
-            self.keysdown.append(SequencerNote(chan, key, vel))
-            nd = len(self.keysdown)
-        else:
-            for k in self.keysdown:
-                if k.key == key:
-                    self.keysdown.remove(k)
-                    break
-            nd = -len(self.keysdown)
-        if self.style in ('up', 'down', 'both'):
-            self.keysdown.sort(key=lambda n: n.key)
-        self.notes = []
-        for i in range(self.octaves):
-            for n in self.keysdown:
-                self.notes.append(SequencerNote(n.chan, n.key + i * 12, n.vel))
-        if self.style == 'down':
-            self.notes.reverse()
-        elif self.style == 'both':
-            self.notes += self.notes[-2:0:-1]
-        elif self.style == 'chord':
-            self.notes = [self.notes]
-            if self.beat < 2:
-                self.play(loops=-1)
-        if nd == 1:
-            self.play(loops=-1)
-        elif nd == 0:
-            self.play(loops=0)
+        self.keyevents.append((chan, key, vel))
+        if len(self.keyevents) == 1:
+            self.transport.call(self._update)
+
+    def dismiss(self):
+        self.keyevents.clear()
+        super().dismiss()
+
+    def _update(self):
+        restart = None
+        while self.keyevents:
+            chan, key, vel = self.keyevents.popleft()
+            if vel > 0:
+                self.notes.press(chan, key, vel)
+                nd = len(self.notes.keys)
+            else:
+                self.notes.release(key)
+                nd = -len(self.notes.keys)
+            if nd == 1 or (self.style == 'chord' and self.beat < 2 and nd != 0):
+                restart = -1
+            elif nd == 0:
+                restart = 0
+        self.compiled = False
+        if restart != None:
+            self.play(loops=restart)
+        elif self.loop != 0:
+            self.requeue()
 
 
 class MidiPlayer:
+    """Plays a MIDI file, with loops and seeks
+
+    The file can be given as a path or as the bytes of the file already
+    in memory. Seeks that are postponed to the end of a bar wait for the
+    next multiple of `barlength` ticks, or if `barlength` is 'auto' for the
+    bar line given by `bars`, a function that finds the file's next bar
+    line after a tick, if it's known.
+    """
 
-    def __init__(self, synth, file, loops, barlength, chan, mask):
+    def __init__(self, synth, file, loops, barlength, chan, mask, bars=None):
         self.fplayer = FS.new_fluid_player(synth.fsynth)
-        FS.fluid_player_add(self.fplayer, str(file).encode())
+        if isinstance(file, bytes):
+            FS.fluid_player_add_mem(self.fplayer, file, len(file))
+        else:
+            FS.fluid_player_add(self.fplayer, str(file).encode())
         self.loops = list(zip(loops[::2], loops[1::2]))
         self.barlength = barlength
+        self.bars = bars
+        self.sendsprogs = 'prog' not in mask
+        self.sendsccs = 'cc' not in mask
         self.seek = None
         self.seek_now = False
         self.lasttick = 0
+        self.nextbar = self._nextbar(0)
         self.frouter_callback = fl_eventcallback(FS.fluid_midi_router_handle_midi_event)
         #self.frouter = FS.new_fluid_midi_router(synth.st, synth.custom_router_callback, synth.frouter)
         self.frouter = FS.new_fluid_midi_router(synth.st, self.frouter_callback, synth.frouter)
         FS.fluid_midi_router_clear_rules(self.frouter)
-        for rtype in set(list(MIDI_TYPES)[:6]) - set(mask):
+        for rtype in set(NATIVE_RULE_TYPES) - set(mask):
             rule = FS.new_fluid_midi_router_rule()
             if chan: fl_midi_router_rule_set_chan(rule, *chan)
-            FS.fluid_midi_router_add_rule(self.frouter, rule, list(MIDI_TYPES).index(rtype))
+            FS.fluid_midi_router_add_rule(self.frouter, rule, NATIVE_RULE_TYPES.index(rtype))
         self.playback_callback = fl_eventcallback(FS.fluid_midi_router_handle_midi_event)
         FS.fluid_player_set_playback_callback(self.fplayer, self.playback_callback, self.frouter)
         self.tickcallback = fl_tickcallback(self.looper)
@@ -474,12 +1004,13 @@ class MidiPlayer:
 
     def looper(self, data, tick):
         if self.seek != None:
-            if self.seek_now or tick % self.barlength < (tick - self.lasttick):
+            if self.seek_now or tick >= self.nextbar:
                 if str(self.seek)[-1] in '+-':
                     inc = int(self.seek[-1] + self.seek[:-1])
                     self.seek = FS.fluid_player_get_current_tick(self.fplayer) + inc
                 if FS.fluid_player_seek(self.fplayer, self.seek) == FLUID_OK:
                     self.lasttick = self.seek
+                    self.nextbar = self._nextbar(self.seek)
                 self.seek = None
         elif self.lasttick < tick:
             for start, end in self.loops:
@@ -489,9 +1020,11 @@ class MidiPlayer:
                         start = 0
                     if FS.fluid_player_seek(self.fplayer, start) == FLUID_OK:
                         self.lasttick = start
+                        self.nextbar = self._nextbar(start)
                     break
             else:
                 self.lasttick = tick
+                if tick >= self.nextbar: self.nextbar = self._nextbar(tick)
 
     def set_tempo(self, bpm=None):
         if bpm:
@@ -504,6 +1037,12 @@ class MidiPlayer:
         FS.fluid_player_stop(self.fplayer)
         FS.delete_fluid_player(self.fplayer)
 
+    def _nextbar(self, tick):
+        # first bar line after tick, found once per bar rather than on every tick
+        if self.barlength != 'auto':
+            return (tick // self.barlength + 1) * self.barlength
+        return self.bars and self.bars(tick) or tick + 1
+
 
 class LadspaEffect:
     
@@ -554,8 +1093,9 @@ class LadspaEffect:
 
 class Synth:
 
-    def __init__(self, **settings):
+    def __init__(self, queuesize=SIGNAL_QUEUE_SIZE, overflow='drop-oldest', **settings):
         self.st = FS.new_fluid_settings()
+        self.settings = {}
         for opt, val in settings.items():
             self.setting(opt, val)
         # create the synth and audio driver
@@ -570,11 +1110,26 @@ class Synth:
         # create a sequencer and register it to the synth
         self.fseq = FS.new_fluid_sequencer2(0)
         self.fsynth_id = FS.fluid_sequencer_register_fluidsynth(self.fseq, self.fsynth)
+        self.transport = Transport(self)
+        self.evpool = MidiEventPool()
         self.clocks = [0, 0]
-        self.xrules = []
+        self.xrules = RuleIndex()
         self.sfid = {}
+        self.sfnames = {}
+        # shadow of the synth's programs, dropped whenever a program change
+        # or anything else that could change them goes to the synth
+        self.programs = {}
+        # shadow of the synth's controller values, read from the synth once per
+        # channel and then kept current from the cc events the router sees
+        self.nchan = self.get_setting('synth.midi-channels')
+        self.ccs = array('B', bytes(128 * self.nchan))
+        self.ccsynced = bytearray(self.nchan)
+        self.ccroutes = None # native cc rules, None for the default rules
         self.players = {}
         self.midi_callback = None
+        self.dispatcher = SignalQueue(self._dispatch_signal, queuesize, overflow)
+        self.subscription = Subscription()
+        self.stats = None
         if LADSPA_SUPPORT:
             nports = self.get_setting('synth.audio-groups')
             nchan = self.get_setting('synth.audio-channels')
@@ -587,65 +1142,159 @@ class Synth:
             self.ladspa = FS.fluid_synth_get_ladspa_fx(self.fsynth)
             self.ladspafx = {}
             
+    def delete(self):
+        """Stop the signal dispatcher and release players and pooled events"""
+        self.dispatcher.stop()
+        self.players_clear()
+        self.evpool.close()
+
     def reset(self):
         FS.fluid_synth_system_reset(self.fsynth)
-
-    def custom_midi_router(self, event):
-        mevent = MidiEvent(event)
+        self.programs = {}
+        self.ccsynced = bytearray(self.nchan)
+
+    def custom_midi_router(self, event, mevent=None):
+        if self.stats == None:
+            return self._route(event, mevent)
+        t0 = time.perf_counter()
+        ret = self._route(event, mevent)
+        self.stats.route_time(time.perf_counter() - t0)
+        return ret
+
+    def _route(self, event, mevent=None):
+        if mevent == None: mevent = MidiEvent.decode(event)
+        if mevent.type == 'prog': self.programs = {}
+        elif mevent.type == None:
+            # sysex and system messages can reset the synth
+            self.programs = {}
+            self.ccsynced = bytearray(self.nchan)
         t = FS.fluid_sequencer_get_tick(self.fseq)
         dt = 0
-        for rule in self.xrules:
+        sub = self.subscription
+        stats = self.stats
+        for rule, action, params in self.xrules.candidates(mevent.type, mevent.chan, mevent.par1):
+            if stats: stats.count(rule, 1)
             if not rule.applies(mevent):
                 continue
-            res = rule.apply(mevent)
-            if isinstance(rule, TransRule):
-                FS.fluid_synth_handle_midi_event(self.fsynth, res.event)
+            if stats: stats.count(rule, 2)
+            if action == None and not (self.midi_callback and sub.wants_rule(params)):
                 continue
-            if 'fluidsetting' in rule:
+            if stats: stats.count(rule, 3)
+            res = rule.apply(mevent)
+            if action == 'transform':
+                if res.type == 'prog': self.programs = {}
+                elif res.type == 'cc': self._shadow_cc(res.chan, res.par1, res.par2)
+                newevent = self.evpool.acquire()
+                FS.fluid_synth_handle_midi_event(self.fsynth, res.encode(newevent))
+                self.evpool.release(newevent)
+            elif action == 'fluidsetting':
                 self.setting(res.fluidsetting, res.val)
-            elif 'sequencer' in rule:
+            elif action == 'sequencer':
                 if res.sequencer in self.players:
                     self.players[res.sequencer].play(res.val)
-            elif 'arpeggiator' in rule:
+            elif action == 'arpeggiator':
                 if res.arpeggiator in self.players:
                     self.players[res.arpeggiator].note(res.chan, res.par1, res.val)
-            elif 'midiplayer' in rule:
+            elif action == 'midiplayer':
                 if res.midiplayer in self.players:
                     if 'tick' in rule:
                         self.players[res.midiplayer].transport(res.val, res.tick)
                     else:
                         self.players[res.midiplayer].transport(res.val)
-            elif 'tempo' in rule:
-                if res.tempo in self.players:
-                    self.players[res.tempo].set_tempo(res.val)
-            elif 'sync' in rule:
-                if res.sync in self.players:
+            elif action == 'tempo':
+                if target := self._tempo_target(res.tempo):
+                    target.set_tempo(res.val)
+            elif action == 'sync':
+                if target := self._tempo_target(res.sync):
                     dt, dt2 = t - self.clocks[0], self.clocks[0] - self.clocks[1]
                     bpm = 1000 * 60 * res.val / dt
-                    if dt2/dt > 0.5: self.players[res.sync].set_tempo(bpm)
-            elif LADSPA_SUPPORT and 'ladspafx' in rule:
+                    if dt2/dt > 0.5: target.set_tempo(bpm)
+            elif action == 'ladspafx':
                 if res.ladspafx in self.ladspafx:
                     self.ladspafx[res.ladspafx].setcontrol(res.port, res.val)
             else:
                 # not handled here, pass it to the callback
-                if self.midi_callback: self.midi_callback(res)
+                self.dispatcher.put(res, self._signal_key(mevent, rule))
         if dt > 0: self.clocks = t, self.clocks[0]
-        if self.midi_callback:
+        if self.midi_callback and sub.wants_event(mevent.type, mevent.chan):
             # send the original event to the callback
-            self.midi_callback(MidiSignal(mevent))
+            self.dispatcher.put(MidiSignal(mevent), self._signal_key(mevent))
         # pass the original event along to the fluid router
+        if mevent.type == 'cc':
+            if self.ccroutes == None: self._shadow_cc(mevent.chan, mevent.par1, mevent.par2)
+            else:
+                for rule in self.ccroutes:
+                    if rule.applies(mevent):
+                        res = rule.apply(mevent)
+                        self._shadow_cc(res.chan, res.par1, res.par2)
         return FS.fluid_midi_router_handle_midi_event(self.frouter, event)
 
+    def _shadow_cc(self, chan, cc, val):
+        if 0 < chan <= self.nchan and 0 <= cc < 128 and 0 <= val < 128:
+            if cc == 121: self.ccsynced[chan - 1] = 0 # reset all controllers
+            else: self.ccs[(chan - 1) * 128 + cc] = val
+
+    def subscribe(self, types=None, chans=None, rules=None):
+        self.subscription = Subscription(types, chans, rules)
+
+    def stats_enable(self, enable=True):
+        self.stats = RouterStats() if enable else None
+
+    def stats_snapshot(self):
+        snap = self.stats.snapshot() if self.stats else {}
+        return dict(snap, queue=self.dispatcher.stats(), eventpool=self.evpool.stats())
+
+    def _dispatch_signal(self, sig):
+        if not self.midi_callback: return
+        stats = self.stats
+        if stats == None:
+            self.midi_callback(sig)
+        else:
+            t0 = time.perf_counter()
+            self.midi_callback(sig)
+            stats.callback_time(time.perf_counter() - t0)
+
+    @staticmethod
+    def _signal_key(mevent, rule=None):
+        if mevent.type in SIGNAL_COALESCE:
+            return id(rule), mevent.type, mevent.chan, mevent.par1 if mevent.type in ('cc', 'kpress') else None
+        return None
+
+    def _programs_tracked(self):
+        # MIDI files can change programs or reset the synth without going through the custom router
+        for player in self.players.values():
+            if isinstance(player, MidiPlayer):
+                if player.sendsprogs or self.get_setting('player.reset-synth'):
+                    return False
+        return True
+
+    def _ccs_tracked(self):
+        for player in self.players.values():
+            if isinstance(player, MidiPlayer):
+                if player.sendsccs or self.get_setting('player.reset-synth'):
+                    return False
+        return True
+
     def setting(self, opt, val):
+        if self.settings.get(opt, None) == val: return
         stype = FS.fluid_settings_get_type(self.st, opt.encode())
         if stype == FLUID_STR_TYPE:
-            FS.fluid_settings_setstr(self.st, opt.encode(), str(val).encode())
+            val = str(val)
+            res = FS.fluid_settings_setstr(self.st, opt.encode(), val.encode())
         elif stype == FLUID_INT_TYPE:
-            FS.fluid_settings_setint(self.st, opt.encode(), int(val))
+            val = int(val)
+            res = FS.fluid_settings_setint(self.st, opt.encode(), val)
         elif stype == FLUID_NUM_TYPE:
-            FS.fluid_settings_setnum(self.st, opt.encode(), c_double(val))
+            val = float(val)
+            res = FS.fluid_settings_setnum(self.st, opt.encode(), c_double(val))
+        else: return
+        if res == FLUID_OK: self.settings[opt] = val
+        else: self.settings.pop(opt, None)
 
     def get_setting(self, opt):
+        if opt in self.settings:
+            val = self.settings[opt]
+            return round(val, 6) if isinstance(val, float) else val
         stype = FS.fluid_settings_get_type(self.st, opt.encode())
         if stype == FLUID_STR_TYPE:
             strval = create_string_buffer(32)
@@ -666,34 +1315,44 @@ class Synth:
         if i == FLUID_FAILED:
             return False
         self.sfid[sfont] = i
+        self.sfnames[i] = sfont
         return True
 
     def unload_soundfont(self, sfont):
         if FS.fluid_synth_sfunload(self.fsynth, self.sfid[sfont], False) == FLUID_FAILED:
             return False
-        del self.sfid[sfont]
+        self.sfnames.pop(self.sfid.pop(sfont), None)
+        self.programs = {ch: p for ch, p in self.programs.items() if p == None or p[0] != sfont}
         return True
 
     def program_select(self, chan, sfont, bank, prog):
         if sfont not in self.sfid:
             return False
+        if self._programs_tracked() and self.programs.get(chan, ()) == (sfont, bank, prog):
+            return True
         x = fl_synth_program_select(self.fsynth, chan, self.sfid[sfont], bank, prog)
         if x == FLUID_FAILED:
+            self.programs.pop(chan, None)
             return False
+        self.programs[chan] = sfont, bank, prog
         return True
 
     def program_unset(self, chan):
+        if self._programs_tracked() and chan in self.programs and self.programs[chan] == None:
+            return
         fl_synth_unset_program(self.fsynth, chan)
+        self.programs[chan] = None
 
     def program_info(self, chan):
+        if self._programs_tracked() and chan in self.programs:
+            return self.programs[chan]
         i = c_int()
         bank = c_int()
         prog = c_int()
         fl_synth_get_program(self.fsynth, chan, byref(i), byref(bank), byref(prog))
-        if i.value not in self.sfid.values():
-            return None
-        sfont = {v: k for k, v in self.sfid.items()}[i.value]
-        return sfont, bank.value, prog.value
+        info = (self.sfnames[i.value], bank.value, prog.value) if i.value in self.sfnames else None
+        self.programs[chan] = info
+        return info
 
     def get_sfpresets(self, sfont):
         presets = []
@@ -709,64 +1368,122 @@ class Synth:
         return presets
 
     def send_event(self, type, chan, par1, par2=None):
-        newevent = MidiEvent(FS.new_fluid_midi_event())
-        newevent.type = type
-        newevent.chan = chan
-        newevent.par1 = par1
-        newevent.par2 = par2
-        self.custom_midi_router(newevent.event)
+        mevent = MidiEvent(type, chan, par1, par2 or 0)
+        if type == 'note' and mevent.par2 == 0: mevent.type = 'noteoff'
+        newevent = self.evpool.acquire()
+        self.custom_midi_router(mevent.encode(newevent), mevent)
+        self.evpool.release(newevent)
 
     def send_sysex(self, data):
-        newevent = MidiEvent(FS.new_fluid_midi_event())
+        # sysex data isn't copied, so it only has to outlive the handler call
+        newevent = self.evpool.acquire()
         syxdata = (c_int * len(data))(*data)
-        FS.fluid_midi_event_set_sysex(newevent.event, syxdata, sizeof(syxdata), True)
-        FS.fluid_midi_router_handle_midi_event(self.frouter, newevent.event)
+        FS.fluid_midi_event_set_sysex(newevent, syxdata, sizeof(syxdata), False)
+        FS.fluid_midi_router_handle_midi_event(self.frouter, newevent)
+        self.evpool.release(newevent)
+        self.programs = {}
+        self.ccsynced = bytearray(self.nchan)
 
     def get_cc(self, chan, ctrl):
+        if 0 < chan <= self.nchan and self.ccsynced[chan - 1] and self._ccs_tracked():
+            return self.ccs[(chan - 1) * 128 + ctrl]
         val = c_int()
         fl_synth_get_cc(self.fsynth, chan, ctrl, byref(val))
         return val.value
 
+    def get_ccs(self, chan):
+        i = (chan - 1) * 128
+        if self.ccsynced[chan - 1] and self._ccs_tracked():
+            return self.ccs[i:i + 128]
+        # mark synced first so events that arrive while reading are kept
+        self.ccsynced[chan - 1] = self._ccs_tracked()
+        val = c_int()
+        for ctrl in range(128):
+            fl_synth_get_cc(self.fsynth, chan, ctrl, byref(val))
+            self.ccs[i + ctrl] = val.value
+        return self.ccs[i:i + 128]
+
     def router_clear(self):
         FS.fluid_midi_router_clear_rules(self.frouter)
-        self.xrules = []
+        self.xrules = RuleIndex()
+        self.ccroutes = ()
 
     def router_default(self):
         FS.fluid_midi_router_set_default_rules(self.frouter)
-        self.xrules = []
+        self.xrules = RuleIndex()
+        self.ccroutes = None
+
+    @staticmethod
+    def router_compile(type, chan, par1, par2, **apars):
+        """Decide where a router rule runs
+
+        Returns a (target, reason) tuple, where target is 'native' for rules
+        fluidsynth's own router can apply, 'python' for rules that must go
+        through custom_midi_router, or None for rules that have no effect,
+        and reason explains why a rule can't run natively.
+        """
+        if isinstance(type, str): type = [type]
+        if type[0] != type[-1]:
+            return 'python', f"changes message type from {type[0]} to {type[-1]}"
+        if apars:
+            for act in RULE_ACTIONS:
+                if act in apars: return 'python', f"controls a {act}"
+            return 'python', f"passes {', '.join(apars)} to the callback"
+        if type[0] not in NATIVE_RULE_TYPES:
+            return None, f"{type[0]} messages can't be routed"
+        return 'native', ''
 
     def router_addrule(self, type, chan, par1, par2, **apars):
-        if type[0] != type[-1]:
-            self.xrules.insert(0, TransRule(type, chan, par1, par2))
-        elif apars:
-            self.xrules.insert(0, CustomRule(type, chan, par1, par2, **apars))
-            if 'arpeggiator' in apars:
-                self.xrules.insert(0, CustomRule('noteoff', chan, par1, (0, 127, 0, 0), **apars))
-        elif type[0] in list(MIDI_TYPES)[:6]:
+        if isinstance(type, str): type = [type]
+        target, reason = self.router_compile(type, chan, par1, par2, **apars)
+        if target == 'native':
             rule = FS.new_fluid_midi_router_rule()
             if chan: fl_midi_router_rule_set_chan(rule, *chan)
             if par1: fl_midi_router_rule_set_param1(rule, *par1)
             if par2: fl_midi_router_rule_set_param2(rule, *par2)
-            FS.fluid_midi_router_add_rule(self.frouter, rule, list(MIDI_TYPES).index(type[0]))
+            FS.fluid_midi_router_add_rule(self.frouter, rule, NATIVE_RULE_TYPES.index(type[0]))
+            if type[0] == 'cc' and self.ccroutes != None:
+                # mirrored so the controller shadow can follow what the synth receives
+                self.ccroutes = (*self.ccroutes, TransRule(type, chan, par1, par2))
+        elif target == 'python' and type[0] != type[-1]:
+            # a rule that changes the message type is a transform, whatever other parameters it has
+            self.xrules = self.xrules.insert(TransRule(type, chan, par1, par2))
+        elif target == 'python':
+            rule = CustomRule(type, chan, par1, par2, **apars)
+            if 'arpeggiator' in apars:
+                self.xrules = self.xrules.insert(CustomRule('noteoff', chan, par1, (0, 127, 0, 0), **apars), rule)
+            else:
+                self.xrules = self.xrules.insert(rule)
+        return target, reason
+
+    def _tempo_target(self, name):
+        if name == 'transport': return self.transport
+        return self.players.get(name)
 
     def players_clear(self, save=[]):
         for name in set(self.players) - set(save):
+            if isinstance(self.players[name], MidiPlayer):
+                # the player may have changed programs or controllers
+                if not self._programs_tracked(): self.programs = {}
+                if not self._ccs_tracked(): self.ccsynced = bytearray(self.nchan)
             self.players[name].dismiss()
+            self.transport.remove(self.players[name])
             del self.players[name]
 
-    def sequencer_add(self, name, notes, tdiv=8, swing=0.5, groove=[1], tempo=120, **_):
+    def sequencer_add(self, name, notes, tdiv=8, swing=0.5, groove=[1], tempo=120, lookahead=1, **_):
         if name not in self.players:
-            self.players[name] = Sequencer(self, notes, tdiv, swing, groove)
+            self.players[name] = Sequencer(self, notes, tdiv, swing, groove, lookahead)
             self.players[name].set_tempo(tempo)
 
-    def arpeggiator_add(self, name, tdiv=8, swing=0.5, groove=[1], style='', octaves=1, tempo=120, **_):
+    def arpeggiator_add(self, name, tdiv=8, swing=0.5, groove=[1], style='', octaves=1, tempo=120, lookahead=1, **_):
         if name not in self.players:
-            self.players[name] = Arpeggiator(self, tdiv, swing, groove, style, octaves)
+            self.players[name] = Arpeggiator(self, tdiv, swing, groove, style, octaves, lookahead)
             self.players[name].set_tempo(tempo)
 
-    def midiplayer_add(self, name, file, loops=[], barlength=1, chan=None, mask=[], tempo=0, **_):
+    def midiplayer_add(self, name, file, loops=[], barlength=1, chan=None, mask=[], tempo=0, bars=None, **_):
         if name not in self.players:
-            self.players[name] = MidiPlayer(self, file, loops, barlength, chan, mask)
+            self.players[name] = MidiPlayer(self, file, loops, barlength, chan, mask, bars)
+            self.transport.add(self.players[name])
             if tempo > 0:
                 self.players[name].set_tempo(tempo)
 
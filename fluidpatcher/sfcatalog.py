@@ -0,0 +1,189 @@
+"""Soundfont preset catalog read from SF2/SF3 headers
+
+Reads the preset, instrument, and sample headers in the `pdta` chunk of
+a soundfont file without touching the sample data, so soundfonts can be
+browsed and banks checked without loading them into FluidSynth. Results
+are stored in an on-disk catalog keyed by file path, size, and mtime.
+"""
+
+import json
+import mmap
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+GEN_INSTRUMENT = 41
+GEN_SAMPLEID = 53
+SAMPLE_COMPRESSED = 0x10 # SF3 Ogg Vorbis samples
+SAMPLE_ROM = 0x8000
+
+
+class SFHeaderError(Exception):
+    pass
+
+
+def _chunks(buf, start, end):
+    """iterate (id, data start, data size) of RIFF chunks in buf[start:end]"""
+    pos = start
+    while pos + 8 <= end:
+        cid, size = struct.unpack_from('<4sI', buf, pos)
+        yield cid, pos + 8, size
+        pos += 8 + size + (size & 1)
+
+
+def _records(buf, start, size, fmt):
+    rsize = struct.calcsize(fmt)
+    return [struct.unpack_from(fmt, buf, start + i * rsize) for i in range(size // rsize)]
+
+
+def _name(raw):
+    return raw.split(b'\0', 1)[0].decode('latin-1').strip()
+
+
+def read_presets(sfont):
+    """Read the presets in a soundfont from its headers
+
+    Args:
+      sfont: path to an SF2 or SF3 file
+
+    Returns: a list of (bank, prog, name, sample bytes, zone count) tuples
+      sorted by bank and program, where sample bytes is the total size of
+      the sample data used by the preset - the 16-bit sample size for SF2,
+      and for SF3 the compressed size stored in the file, since the decoded
+      size isn't known without decoding the samples
+    """
+    with open(sfont, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        riff, size, form = struct.unpack_from('<4sI4s', buf, 0)
+        if riff != b'RIFF' or form != b'sfbk':
+            raise SFHeaderError(f"{sfont} is not a soundfont")
+        pdta = {}
+        for cid, start, size in _chunks(buf, 12, len(buf)):
+            if cid == b'LIST' and buf[start:start + 4] == b'pdta':
+                pdta = {c: (s, n) for c, s, n in _chunks(buf, start + 4, start + size)}
+                break
+        try:
+            phdr = _records(buf, *pdta[b'phdr'], '<20sHHHIII')
+            pbag = _records(buf, *pdta[b'pbag'], '<HH')
+            pgen = _records(buf, *pdta[b'pgen'], '<HH')
+            inst = _records(buf, *pdta[b'inst'], '<20sH')
+            ibag = _records(buf, *pdta[b'ibag'], '<HH')
+            igen = _records(buf, *pdta[b'igen'], '<HH')
+            shdr = _records(buf, *pdta[b'shdr'], '<20sIIIIIBbHH')
+        except KeyError as e:
+            raise SFHeaderError(f"{sfont} is missing the {e.args[0].decode()} chunk") from e
+    sampbytes = []
+    for _, start, end, _, _, _, _, _, _, stype in shdr[:-1]:
+        if stype & SAMPLE_ROM: sampbytes.append(0)
+        elif stype & SAMPLE_COMPRESSED: sampbytes.append(end - start)
+        else: sampbytes.append((end - start) * 2)
+    def gens(bags, gens, first, last, oper):
+        vals = set()
+        for b in range(first, min(last, len(bags) - 1)):
+            for g in range(bags[b][0], min(bags[b + 1][0], len(gens))):
+                if gens[g][0] == oper: vals.add(gens[g][1])
+        return vals
+    isamples = [gens(ibag, igen, inst[i][1], inst[i + 1][1], GEN_SAMPLEID)
+                for i in range(len(inst) - 1)]
+    presets = []
+    for i in range(len(phdr) - 1):
+        name, prog, bank, bagndx = phdr[i][:4]
+        samples = set()
+        for n in gens(pbag, pgen, bagndx, phdr[i + 1][3], GEN_INSTRUMENT):
+            if n < len(isamples): samples |= isamples[n]
+        nbytes = sum(sampbytes[s] for s in samples if s < len(sampbytes))
+        presets.append((bank, prog, _name(name), nbytes, phdr[i + 1][3] - bagndx))
+    return sorted(presets)
+
+
+def _read_entry(path):
+    try:
+        return path, read_presets(path)
+    except (OSError, ValueError, struct.error, SFHeaderError):
+        return path, None
+
+
+class SoundfontCatalog:
+    """An on-disk catalog of soundfont presets
+
+    Entries are keyed by resolved file path and are considered valid as long
+    as the file's size and mtime haven't changed. Soundfonts that can't be
+    read are cataloged as having no presets.
+
+    Attributes:
+      file: Path of the JSON catalog file, or None to keep it in memory only
+    """
+
+    def __init__(self, file=None):
+        self.file = Path(file) if file else None
+        self.entries = {}
+        self.changed = False
+        if self.file:
+            try: self.entries = json.loads(self.file.read_text())
+            except (OSError, ValueError): self.entries = {}
+
+    def presets(self, sfont):
+        """Get the presets in a soundfont, reading its headers if needed
+
+        Args:
+          sfont: path to the soundfont
+
+        Returns: a list of (bank, prog, name, sample bytes, zone count) tuples,
+          or None if the soundfont couldn't be read
+        """
+        path, key = self._key(sfont)
+        if key == None: return None
+        entry = self.entries.get(path)
+        if entry == None or entry['key'] != key:
+            _, presets = _read_entry(path)
+            entry = self._store(path, key, presets)
+        return [tuple(p) for p in entry['presets']] if entry['presets'] != None else None
+
+    def rebuild(self, sfonts, workers=None):
+        """Catalog soundfonts in parallel
+
+        Soundfonts that are missing from the catalog or out of date are read
+        using a pool of worker processes. Entries for files that no longer
+        exist are removed.
+
+        Args:
+          sfonts: paths of soundfonts to catalog
+          workers: number of processes to use, defaults to the number of CPUs
+        """
+        stale = {}
+        for sfont in sfonts:
+            path, key = self._key(sfont)
+            if key == None: continue
+            if path not in self.entries or self.entries[path]['key'] != key:
+                stale[path] = key
+        if len(stale) > 1 and (workers or os.cpu_count() or 1) > 1:
+            with ProcessPoolExecutor(workers) as pool:
+                for path, presets in pool.map(_read_entry, stale):
+                    self._store(path, stale[path], presets)
+        else:
+            for path in stale:
+                self._store(path, stale[path], _read_entry(path)[1])
+        for path in list(self.entries):
+            if not Path(path).is_file():
+                del self.entries[path]
+                self.changed = True
+
+    def save(self):
+        """Write the catalog to `file` if it has changed"""
+        if self.file and self.changed:
+            try:
+                self.file.write_text(json.dumps(self.entries))
+                self.changed = False
+            except OSError:
+                pass
+
+    def _key(self, sfont):
+        path = Path(sfont).resolve()
+        try: st = path.stat()
+        except OSError: return str(path), None
+        return str(path), [st.st_size, st.st_mtime_ns]
+
+    def _store(self, path, key, presets):
+        self.entries[path] = entry = dict(key=key, presets=presets)
+        self.changed = True
+        return entry
@@ -11,6 +11,7 @@ import subprocess
 import sys
 import time
 import traceback
+from collections import deque
 
 from fluidpatcher import FluidPatcher
 
@@ -49,6 +50,7 @@ def connect_controls():
         fp.add_router_rule(type=TYPE, chan=CHAN, par1=INC_PATCH, shutdown=1)
 
 POLL_TIME = 0.025
+SIGNAL_BACKLOG = 256
 ACT_LED = ''
 for path in [Path('/sys/class/leds/led0'), Path('/sys/class/leds/ACT')]:
     if path.exists():
@@ -107,11 +109,14 @@ class HeadlessSynth:
     def __init__(self):
         self.shutdowntimer = 0
         self.pno = 0
-        fp.midi_callback = self.listener
+        self.signals = deque(maxlen=SIGNAL_BACKLOG)
+        fp.midi_callback = self.signals.append
+        fp.subscribe(types=[], rules=['patch', 'bank', 'shutdown'])
         self.load_bank(fp.currentbank)
         onboardled_blink(ACT_LED, 5) # ready to play
         while True:
             time.sleep(POLL_TIME)
+            self.poll_signals()
             if self.shutdowntimer:
                 t = time.time()
                 if t - self.shutdowntimer > 7:
@@ -149,6 +154,15 @@ class HeadlessSynth:
         print(f"Selected patch {n + 1}/{len(fp.patches)}: {fp.patches[n]}")
         onboardled_blink(ACT_LED)
 
+    def poll_signals(self):
+        """Handles MidiSignals queued since the last call
+
+        FluidPatcher calls midi_callback on its dispatcher thread, so signals
+        are queued there and handled here on the main thread.
+        """
+        while self.signals:
+            self.listener(self.signals.popleft())
+
     def listener(self, sig):
     # catches custom midi :sig to change patch/bank
         if hasattr(sig, 'patch'):
@@ -157,10 +171,9 @@ class HeadlessSynth:
             else:
                 self.select_patch(sig.patch)
         if hasattr(sig, 'bank') and sig.val > 0:
-            banks = sorted([b.relative_to(fp.bankdir) for b in fp.bankdir.rglob('*.yaml')])
-            bno = (banks.index(fp.currentbank) + 1 ) % len(banks) if fp.currentbank in banks else 0
-            self.load_bank(banks[bno])
+            self.load_bank(fp.next_bank())
             fp.write_config()
+            if fp.cfg.get('sfcache', {}).get('budget'): fp.prefetch_bank()
         if hasattr(sig, 'shutdown'):
             if self.shutdowntimer:
                 self.shutdowntimer = 0
@@ -27,6 +27,7 @@ import sys
 import threading
 import time
 import traceback
+from collections import deque
 
 import RPi.GPIO as GPIO
 
@@ -66,6 +67,7 @@ BLINK_TIME = 0.1
 SCROLL_TIME = 0.4
 SCROLL_PAUSE = 4
 POLL_TIME = 0.01
+SIGNAL_BACKLOG = 256
 BOUNCE_TIME = 0.02
 COLS, ROWS = 16, 2
 
@@ -104,6 +106,9 @@ class SquishBox():
           buttoncallback: When the state of a button connected to BTN_SW
             changes, this function is called with 1 if the button was
             pressed, 0 if it was released.
+          idlecallback: if set, this function is called with no arguments
+            every time update() polls the buttons, so that queued work is
+            also done while menus are waiting for input.
           wificon: contains either the WIFIUP or WIFIDOWN character
             depending on the last-known status of the wifi adapter
         """
@@ -127,6 +132,7 @@ class SquishBox():
         self.encstate = 0b000000
         self.encvalue = 0
         self.buttoncallback = None
+        self.idlecallback = None
 
         for val in (0x33, 0x32, 0x28, 0x0c, 0x06):
             self._lcd_send(val)
@@ -162,6 +168,7 @@ class SquishBox():
 
         Returns: an integer event code
         """
+        if self.idlecallback: self.idlecallback()
         callback = self.buttoncallback if callback else None
         t = time.time()
         for r in range(ROWS):
@@ -478,7 +485,7 @@ class SquishBox():
                 self._lcd_setcursormode('hide')
                 return ''
 
-    def choose_file(self, topdir, last='', ext=None):
+    def choose_file(self, topdir, last='', ext=None, index=None):
         """Lets user browse and select a file on the system
         
         Finds files of a specified type on the file system and lets the
@@ -492,21 +499,27 @@ class SquishBox():
           topdir: Path of the highest-level directory the user may see
           last: Path of the file to show as the initial choice
           ext: the file extensions to show, if None shows all files
+          index: a FileIndex of `topdir` to list directories from instead
+            of reading them, in which case `ext` is ignored
 
         Returns: Path of the chosen file or empty string if canceled
         """
         cdir = topdir if last == '' else (last.parent if last.parent > topdir else topdir)
         while True:
             self.lcd_write(f"{str(cdir.relative_to(topdir.parent))}/:", ROWS - 2, mode='scroll')
-            x = sorted([p for p in cdir.glob('*') if p.is_dir() or p.suffix == ext or ext == None])
-            y = [f"{SUBDIR}{p.name}/" if p.is_dir() else p.name for p in x]
+            if index: entries = index.listdir(cdir)
+            else: entries = sorted([(p, p.is_dir()) for p in cdir.glob('*') if p.is_dir() or p.suffix == ext or ext == None])
+            x = [p for p, _ in entries]
+            isdir = [d for _, d in entries]
+            y = [f"{SUBDIR}{p.name}/" if d else p.name for p, d in entries]
             i = x.index(last) if last in x else 0
             if cdir != topdir:
                 x.append(cdir.parent)
+                isdir.append(True)
                 y.append("../")
             j = self.choose_opt(y, ROWS - 1, i, mode='scroll', timeout=-1)
             if j < 0: return ''
-            if x[j].is_dir():
+            if isdir[j]:
                 last = cdir
                 cdir = x[j]
             else:
@@ -706,8 +719,12 @@ class FluidBox:
         """Creates the FluidBox"""
         self.pno = 0
         self.buttonstate = 0
-        fp.midi_callback = self.listener
+        self.signals = deque(maxlen=SIGNAL_BACKLOG)
+        self.polling = False
+        fp.midi_callback = self.signals.append
+        fp.subscribe(types=['note', 'noteoff', 'cc', 'prog', 'pbend', 'cpress', 'kpress'])
         sb.buttoncallback = self.handle_buttonevent
+        sb.idlecallback = self.poll_signals
         self.midi_connect()
         self.load_bank(fp.currentbank)
         while not fp.currentbank:
@@ -727,6 +744,23 @@ class FluidBox:
             fp.send_event(f"cc:{STOMP_MIDICHANNEL}:{STOMP_TOGGLE_CC}:{self.buttonstate}")
             sb.gpio_set(PIN_LED, self.buttonstate)
 
+    def poll_signals(self):
+        """Handles MidiSignals queued since the last call
+
+        FluidPatcher calls midi_callback on its dispatcher thread, so signals
+        are queued there and handled here on the main thread. This is called
+        every time sb.update() polls, so signals are handled while menus are
+        open too. A patch change signalled while a menu is open is applied
+        once the menu closes.
+        """
+        if self.polling: return
+        self.polling = True
+        try:
+            while self.signals:
+                self.listener(self.signals.popleft())
+        finally:
+            self.polling = False
+
     def listener(self, sig):
         """Handles MidiSignals from FluidPatcher
         
@@ -827,7 +861,7 @@ class FluidBox:
                             self.pno = min(self.pno, len(fp.patches) - 1)
                             return
                     elif k == 4:
-                        if sfont := sb.choose_file(fp.sfdir, ext='.sf2'):
+                        if sfont := sb.choose_file(fp.sfdir, ext='.sf2', index=fp.sfindex):
                             self.sfmode(sfont)                            
                             sb.lcd_write("loading patches ", 1, mode='ljust', now=True)
                             sb.progresswheel_start()
@@ -886,7 +920,7 @@ class FluidBox:
         lastpatch = fp.patches[self.pno] if fp.patches else ""
         if bank == "":
             last = fp.bankdir / fp.currentbank if fp.currentbank else ""
-            bank = sb.choose_file(fp.bankdir, last, '.yaml')
+            bank = sb.choose_file(fp.bankdir, last, '.yaml', fp.bankindex)
             if bank == "": return False
         sb.lcd_write(bank.name, 0, mode='scroll', now=True)
         sb.lcd_write("loading patches ", 1, mode='ljust', now=True)
@@ -910,7 +944,7 @@ class FluidBox:
     def save_bank(self, bank=""):
         """Bank saving menu"""
         if bank == "":
-            bank = sb.choose_file(fp.bankdir, fp.bankdir / fp.currentbank, '.yaml')
+            bank = sb.choose_file(fp.bankdir, fp.bankdir / fp.currentbank, '.yaml', fp.bankindex)
             if bank == "": return
             name = sb.char_input(bank.name)
             if name == "": return
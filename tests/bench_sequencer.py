@@ -0,0 +1,105 @@
+"""Benchmark for queueing sequencer steps
+
+Times Sequencer.fill() on a long pattern against queueing the same
+steps one at a time, the way sequencers did before their patterns were
+compiled, and times compiling a pattern and arpeggiator key presses. Run
+`python -m tests.bench_sequencer` from the top directory. With
+--no-send, events aren't sent to fluidsynth, so only the Python side
+of queueing is measured.
+"""
+
+import sys
+import time
+from fluidpatcher import pfluidsynth as pf
+from fluidpatcher.pfluidsynth import FS, fl_event_noteon, fl_event_noteoff
+
+NOTES = [('note', 1, 40 + i % 60, 100) for i in range(400)]
+BARS = 1000
+
+
+class BenchSynth:
+    """just enough of a Synth for sequencers to queue events"""
+
+    def __init__(self):
+        self.fseq = FS.new_fluid_sequencer2(0)
+        self.fsynth_id = -1
+        self.transport = pf.Transport(self)
+
+
+def fill_per_step(seq, wake):
+    """queue steps through the horizon, working out each one as it's queued"""
+    horizon = wake + seq.ticksperbeat * 2 * seq.lookahead
+    evt = seq._event()
+    while seq.loop != 0 and seq.nextnote < horizon:
+        dur = seq.ticksperbeat * 4 / seq.tdiv
+        if seq.tdiv >= 8 and seq.tdiv % 3:
+            if seq.beat % 2: dur *= 2 * (1 - seq.swing)
+            else: dur *= 2 * seq.swing
+        pos = seq.beat % len(seq.notes)
+        accent = seq.groove[seq.beat % len(seq.groove)]
+        seq.chunks.append((seq.nextnote, seq.beat, seq.loop))
+        for chan, key, vel in seq.notes[pos]:
+            fl_event_noteon(evt, chan, key, int(min(vel * accent, 127)))
+            FS.fluid_sequencer_send_at(seq.fseq, evt, int(seq.nextnote), 1)
+            fl_event_noteoff(evt, chan, key)
+            FS.fluid_sequencer_send_at(seq.fseq, evt, int(seq.nextnote + dur), 1)
+            seq.sounding.append((seq.nextnote, seq.nextnote + dur, chan, key))
+        seq.nextnote += dur
+        seq.beat += 1
+    FS.delete_fluid_event(evt)
+
+
+def bench_fill(synth, fill, repeat=5):
+    """best time of `repeat` runs to queue one bar"""
+    best = None
+    for _ in range(repeat):
+        seq = pf.Sequencer(synth, NOTES, 16, 0.6, [1.2, 1, 0.8])
+        seq.set_tempo(120)
+        seq.fill(0)
+        seq.loop = -1
+        bar = 4 * seq.ticksperbeat
+        t0 = time.perf_counter()
+        for n in range(BARS):
+            fill(seq, n * bar)
+            seq.chunks, seq.sounding = [], []
+            FS.fluid_sequencer_remove_events(synth.fseq, seq.source, -1, -1)
+        elapsed = (time.perf_counter() - t0) / BARS
+        best = elapsed if best == None else min(best, elapsed)
+    return best
+
+
+def bench_compile(synth):
+    seq = pf.Sequencer(synth, NOTES, 16, 0.6, [1.2, 1, 0.8])
+    t0 = time.perf_counter()
+    for _ in range(100): seq._compile()
+    return (time.perf_counter() - t0) / 100
+
+
+def bench_note(synth):
+    arp = pf.Arpeggiator(synth, 16, 0.5, [1], 'up', 2)
+    arp.set_tempo(120)
+    for key in (60, 64, 67): arp.note(1, key, 100)
+    arp._update()
+    note = update = 0
+    for _ in range(500):
+        for vel in (100, 0):
+            t0 = time.perf_counter()
+            arp.note(1, 72, vel)
+            t1 = time.perf_counter()
+            arp._update()
+            note, update = note + t1 - t0, update + time.perf_counter() - t1
+    arp.dismiss()
+    return note / 1000, update / 1000
+
+
+if __name__ == '__main__':
+    if '--no-send' in sys.argv:
+        FS.fluid_sequencer_send_at = lambda *args: 0
+    synth = BenchSynth()
+    compiled = bench_fill(synth, lambda seq, wake: seq.fill(wake))
+    perstep = bench_fill(synth, fill_per_step)
+    print(f"fill one bar, {len(NOTES)}-step pattern: compiled {compiled * 1e6:.1f}us, "
+          f"per step {perstep * 1e6:.1f}us ({perstep / compiled:.1f}x)")
+    print(f"compile {len(NOTES)}-step pattern: {bench_compile(synth) * 1e6:.1f}us")
+    note, update = bench_note(synth)
+    print(f"Arpeggiator.note(): {note * 1e6:.1f}us, then on the sequencer's thread {update * 1e6:.1f}us")
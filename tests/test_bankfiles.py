@@ -0,0 +1,106 @@
+"""Parity checks for bank parsing and rendering
+
+Checks that the shipped banks parse to the same data and render to
+yaml that parses back to the same data with each of the yaml loaders
+and dumpers fluidpatcher registers its extensions on (pure Python and,
+when available, libyaml), and that parsebank() gives the same banks
+as parsing them all at once. Run `python -m pytest tests` from the top
+directory, or `python -m tests.test_bankfiles` to also print how long
+each loader and dumper and parsebank() take.
+"""
+
+import time
+from pathlib import Path
+import yaml
+import pytest
+from fluidpatcher.bankfiles import (LOADERS, DUMPERS, BankObject, SFPreset, MidiMessage,
+                                    PatchBank, parsebank, parseyaml)
+
+BANKS = sorted((Path(__file__).parent.parent / 'SquishBox' / 'banks').glob('*.yaml'))
+EDGE_CASES = [
+    "patches:\n  A: {1: a.sf2:0:1}\n  B:\n    1: b.sf2:0:2\n",
+    "patches:\n  A: &x\n    1: a.sf2:0:1\n  B: *x\n",
+    "x: &y 5\npatches:\n  A:\n    1: a.sf2:0:1\n    cc: *y\n",
+    "patches:\n  'A: b':\n    1: a.sf2:0:1\n  \"C:d\" :  # c\n    2: c.sf2:1:2\nother: 3\n",
+    "patches:   # p\n  1:\n    1: a.sf2:0:1 # c\n    router_rules: [{type: note, chan: 1=2}]\n"
+    "    midiplayers:\n      m: {file: x.mid}\n\n  2.5:\n    3: 'q.sf2:0:1'\nlast: {a: 1}\n",
+    "patches:\r\n  A:\r\n    1: a.sf2:0:1\r\n  A:\r\n    2: b.sf2:0:1\r\nz: 1\r\n",
+    "patches:\n  A:\n    1: a.sf2:0:1\n    x: ~\n  B:\n    1: b.sf2:0:0\n",
+    "patches:\n  A:\n    1: a.sf2:0:1\n    x: [1, !!null '']\n",
+]
+TAGS = {'!sfpreset', '!midimsg', '!rrule', '!midiplayer', '!sequencer', '!arpeggiator', '!ladspafx'}
+
+
+def plain(data, tags):
+    """reduce parsed bank data to builtin types, collecting the tags found"""
+    if isinstance(data, BankObject):
+        tags.add(data.yaml_tag)
+        return data.yaml_tag, plain(data.opars, tags)
+    if isinstance(data, (SFPreset, MidiMessage)):
+        tags.add(data.yaml_tag)
+        return data.yaml_tag, str(data)
+    if isinstance(data, (dict, PatchBank)):
+        return {k: plain(data[k], tags) for k in data}
+    if isinstance(data, list):
+        return [plain(item, tags) for item in data]
+    return data
+
+
+def test_banks_found():
+    assert BANKS
+
+
+def test_parse_parity():
+    tags = set()
+    for bank in BANKS:
+        text = bank.read_text()
+        results = [plain(yaml.load(text, Loader=loader), tags) for loader in LOADERS]
+        assert all(r == results[0] for r in results), bank.name
+    assert tags == TAGS
+
+
+def test_render_parity():
+    for bank in BANKS:
+        text = bank.read_text()
+        for loader in LOADERS:
+            data = yaml.load(text, Loader=loader)
+            expected = plain(data, set())
+            for dumper in DUMPERS:
+                out = yaml.dump(data, Dumper=dumper, sort_keys=False)
+                for loader2 in LOADERS:
+                    again = yaml.load(out, Loader=loader2)
+                    assert plain(again, set()) == expected, (bank.name, loader, dumper, loader2)
+
+
+
+def test_parsebank_parity():
+    for text in [bank.read_text() for bank in BANKS] + EDGE_CASES:
+        bank, expected = parsebank(text), parseyaml(text)
+        assert plain(bank, set()) == plain(expected, set()), text
+        if expected == None: continue
+        patches = bank['patches']
+        for name, patch in expected['patches'].items():
+            assert patches.presets(name) == {(p.sfont, p.bank, p.prog) for ch, p in patch.items()
+                                             if isinstance(ch, int) and isinstance(p, SFPreset)}
+            assert patches.mfiles(name) == {m['file'] for m in patch.get('midiplayers', {}).values()}
+
+
+def test_parsebank_errors():
+    with pytest.raises(yaml.YAMLError):
+        parsebank("patches:\n  A:\n    1: a.sf2:0:1\n    x: [1, 2\n  B:\n    1: b.sf2:0:0\n")
+
+
+if __name__ == '__main__':
+    for bank in BANKS:
+        text = bank.read_text()
+        for loader, dumper in zip(LOADERS, DUMPERS):
+            t0 = time.perf_counter()
+            for _ in range(10): data = yaml.load(text, Loader=loader)
+            t1 = time.perf_counter()
+            for _ in range(10): yaml.dump(data, Dumper=dumper, sort_keys=False)
+            t2 = time.perf_counter()
+            print(f"{bank.name}: {loader.__name__} {(t1 - t0) * 100:.2f}ms, "
+                  f"{dumper.__name__} {(t2 - t1) * 100:.2f}ms")
+        t0 = time.perf_counter()
+        for _ in range(10): parsebank(text)
+        print(f"{bank.name}: parsebank {(time.perf_counter() - t0) * 100:.2f}ms")
@@ -0,0 +1,63 @@
+"""Checks for reading MIDI files and finding their bar lines
+
+Run `python -m pytest tests` from the top directory.
+"""
+
+import struct
+import time
+import pytest
+from fluidpatcher.midifiles import MidiFile, MidiFileError
+
+
+def varlen(n):
+    out = [n & 0x7f]
+    n >>= 7
+    while n:
+        out.append(0x80 | n & 0x7f)
+        n >>= 7
+    return bytes(reversed(out))
+
+
+def smf(events, division=96):
+    """a format 0 file from (delta ticks, event bytes) pairs"""
+    track = b''.join(varlen(d) + e for d, e in events) + b'\x00\xff\x2f\x00'
+    return (b'MThd' + struct.pack('>IHHH', 6, 0, 1, division)
+            + b'MTrk' + struct.pack('>I', len(track)) + track)
+
+
+def timesig(nn, dd):
+    return b'\xff\x58\x04' + bytes([nn, dd, 24, 8])
+
+
+def test_default_bars():
+    mfile = MidiFile(smf([(1000, b'\x90\x40\x40')]))
+    assert mfile.length == 1000
+    assert [mfile.nextbar(t) for t in (0, 383, 384, 1000)] == [384, 384, 768, 1152]
+
+
+def test_timesig_changes():
+    # 3/4 from the start, then 6/8 replaced by 2/2 partway into the third bar,
+    # which takes effect when the third bar ends
+    mfile = MidiFile(smf([(0, timesig(3, 2)), (600, timesig(6, 3)), (0, timesig(2, 1))]))
+    assert [mfile.nextbar(t) for t in (0, 288, 575, 576, 863, 864, 1247)] == [288, 576, 576, 864, 864, 1248, 1248]
+
+
+def test_long_delta():
+    # a single huge delta time mustn't cost anything to index
+    data = b'MThd' + struct.pack('>IHHH', 6, 0, 1, 1) + b'MTrk' + struct.pack('>I', 7) + varlen(0x0fffffff) + b'\xff\x2f\x00'
+    t0 = time.perf_counter()
+    mfile = MidiFile(data)
+    assert time.perf_counter() - t0 < 0.1
+    assert mfile.nextbar(mfile.length) == mfile.length + 1
+
+
+def test_smpte():
+    data = b'MThd' + struct.pack('>IHHbB', 6, 0, 1, -25, 40) + b'MTrk' + struct.pack('>I', 4) + b'\x00\xff\x2f\x00'
+    assert MidiFile(data).nextbar(10) == None
+
+
+def test_errors():
+    with pytest.raises(MidiFileError):
+        MidiFile(b'RIFF' + bytes(20))
+    with pytest.raises(MidiFileError):
+        MidiFile(smf([(0, b'\x90\x40\x40')])[:-6])